@@ -3,15 +3,16 @@ import asyncio
 import structlog
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 
 from app.routes import sync_task_router
 from app.routes.auth import router as auth_routes
 from app.routes.sync_task_websocket import status_updates_listener
-from tools.database import engine, Base
+from tools import database, health, metrics, util_redis
 
 log = structlog.get_logger()
 
-Base.metadata.create_all(bind=engine)
+# No schema work here (it'd run on every start and every reload): see app/migrate.py
 app = FastAPI()
 app.include_router(sync_task_router)
 app.include_router(auth_routes)
@@ -21,6 +22,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allow all HTTP methods (GET, POST, etc.)
     allow_headers=["*"],  # Allow all headers
+    expose_headers=["X-Next-Cursor"],  # GET /sync pagination
 )
 
 
@@ -29,8 +31,62 @@ def read_root():
     return {"message": "Backend is running"}
 
 
+@app.get("/metrics")
+def get_metrics():
+    """This process' metrics (see tools.metrics), in Prometheus' text format."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/health/live")
+def get_liveness():
+    """The process is up and its event loop answers (see tools.health)."""
+    return health.liveness()
+
+
+@app.get("/health/ready")
+async def get_readiness(response: Response):
+    """
+    Whether the DB pool, Redis and the status updates consumer are warm.
+    HTTP 503 until they are (see tools.health).
+    """
+    ready, checks = await health.readiness()
+    if not ready:
+        response.status_code = 503
+    return {"ready": ready, "checks": checks}
+
+
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _run_in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
 @app.on_event("startup")
 async def startup_event():
-    """Runs when the FastAPI server starts."""
+    """
+    Runs when the FastAPI server starts. Nothing here waits for the DB, Redis or Kafka: they
+    warm up in the background (so the server starts right away) and /health/ready tells
+    when they're done.
+    """
     log.info("Starting the FastAPI server")
-    asyncio.create_task(status_updates_listener())
+    health.add_probe("db", database.ping)
+    health.add_probe("redis", util_redis.ping)
+    _run_in_background(health.warm_up("db_pool", database.warm_up))
+    # No producer: the backend doesn't publish anything (the outbox relay does, see
+    # worker/outbox_relay.py), so it doesn't need the broker to be up to serve requests
+    _run_in_background(status_updates_listener())
+    _run_in_background(database.run_replica_health_checks())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Runs when the FastAPI server stops."""
+    log.info("Stopping the FastAPI server")
+    # Before Redis goes: the status updates listener removes its consumer group on its way out
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await util_redis.close_async_client()
@@ -0,0 +1,109 @@
+"""
+Creates (or brings up to date) the database schema. Run it before starting a new version of
+the backend or the worker, from backend/:
+    python -m app.migrate [--backfill]
+This used to be a create_all() at import time of app.main, so every process (and every
+auto-reload) paid a round trip per table for it. It's idempotent:
+- Creates the tables that don't exist yet
+- Adds the columns and indexes the models have but existing tables don't (added columns
+  must be nullable or have a server default)
+- Fills latest_sync_tasks from sync_tasks when that table gets created (or with --backfill)
+Renaming or dropping things is not its business: do that by hand.
+"""
+
+import argparse
+import time
+
+import sqlalchemy as sa
+import structlog
+from sqlalchemy.engine import Connection
+
+from app.models import LatestSyncTask, SyncTask
+from tools.database import Base, engine
+
+log = structlog.get_logger()
+
+
+def _add_missing_columns(conn: Connection, inspector, table: sa.Table) -> list[str]:
+    existing = {column["name"] for column in inspector.get_columns(table.name)}
+    added = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        if not column.nullable and column.server_default is None:
+            raise RuntimeError(
+                f"Can't add {table.name}.{column.name}: NOT NULL columns need a server default"
+            )
+        table_name = conn.dialect.identifier_preparer.format_table(table)
+        column_ddl = sa.schema.CreateColumn(column).compile(dialect=conn.dialect)
+        conn.execute(sa.text(f"ALTER TABLE {table_name} ADD COLUMN {column_ddl}"))
+        added.append(column.name)
+    return added
+
+
+def _add_missing_indexes(conn: Connection, inspector, table: sa.Table) -> list[str]:
+    existing = {index["name"] for index in inspector.get_indexes(table.name)}
+    added = []
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(conn)
+            added.append(index.name)
+    return added
+
+
+def backfill_latest_sync_tasks(conn: Connection) -> int:
+    """
+    Rebuild latest_sync_tasks (see app.models.latest_sync_task): the most recent task of
+    each user/meeting/status. Returns how many entries it has now.
+    """
+    latest = (
+        sa.select(sa.func.max(SyncTask.id))
+        .where(
+            SyncTask.user_id.is_not(None),
+            SyncTask.meeting_id.is_not(None),
+            SyncTask.status.is_not(None),
+        )
+        .group_by(SyncTask.user_id, SyncTask.meeting_id, SyncTask.status)
+    )
+    current = sa.select(
+        SyncTask.user_id, SyncTask.meeting_id, SyncTask.status, SyncTask.id, SyncTask.updated_at
+    ).where(SyncTask.id.in_(latest))
+    columns = ["user_id", "meeting_id", "status", "task_id", "updated_at"]
+    conn.execute(sa.delete(LatestSyncTask))
+    conn.execute(sa.insert(LatestSyncTask).from_select(columns, current))
+    return conn.execute(sa.select(sa.func.count()).select_from(LatestSyncTask)).scalar_one()
+
+
+def migrate(backfill: bool = False):
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        inspector = sa.inspect(conn)
+        existing = set(inspector.get_table_names())
+        created = [t.name for t in Base.metadata.sorted_tables if t.name not in existing]
+        Base.metadata.create_all(conn)
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            columns = _add_missing_columns(conn, inspector, table)
+            indexes = _add_missing_indexes(conn, inspector, table)
+            if columns or indexes:
+                log.info("Upgraded table", table=table.name, columns=columns, indexes=indexes)
+        if created:
+            log.info("Created tables", tables=created)
+        if backfill or LatestSyncTask.__tablename__ in created:
+            entries = backfill_latest_sync_tasks(conn)
+            log.info("Backfilled latest_sync_tasks", entries=entries)
+    log.info("Database schema is up to date", seconds=round(time.perf_counter() - started, 3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create or upgrade the database schema")
+    parser.add_argument(
+        "--backfill", action="store_true", help="Rebuild latest_sync_tasks from sync_tasks"
+    )
+    args = parser.parse_args()
+    migrate(backfill=args.backfill)
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,4 @@
-from .sync_task import SyncTask
\ No newline at end of file
+from .sync_task import SyncTask
+from .outbox import OutboxMessage
+from .latest_sync_task import LatestSyncTask, refresh_latest_sync_tasks
+from .archived_sync_task import ArchivedSyncTask
@@ -0,0 +1,28 @@
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy import Column, String, DateTime
+
+from app.models.sync_task import BigIntId
+from tools.database import Base
+
+
+class ArchivedSyncTask(Base):
+    """
+    Finished sync tasks older than the retention period (see worker/archiver.py), moved out
+    of sync_tasks so that one only holds recent history. Same columns (and IDs), plus when
+    it was archived. Written once, read rarely: compressed, and no indexes but the key.
+    """
+
+    __tablename__ = "sync_tasks_archive"
+
+    id = Column(BigIntId, primary_key=True, autoincrement=False)  # The one it had in sync_tasks
+    user_id = Column(String(128))
+    meeting_id = Column(BigIntId)
+    status = Column(String(128))
+    status_version = Column(sa.Integer, nullable=False, default=0, server_default="0")
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = {"mysql_row_format": "COMPRESSED", "mysql_key_block_size": "8"}
@@ -0,0 +1,64 @@
+import typing
+
+import sqlalchemy as sa
+from sqlalchemy import Column, String, DateTime
+from sqlalchemy.dialects import mysql, sqlite
+
+from app.models.sync_task import BigIntId, SyncTask
+from tools.database import Base
+
+if typing.TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+
+class LatestSyncTask(Base):
+    """
+    Projection of sync_tasks: the most recent task of each user/meeting/status. This is what
+    GET /sync shows, so keep it up to date (see refresh_latest_sync_tasks) whenever a task is
+    created or changes status. The primary key doubles as the index GET /sync pages through.
+    """
+
+    __tablename__ = "latest_sync_tasks"
+
+    user_id = Column(String(128), primary_key=True)
+    meeting_id = Column(BigIntId, primary_key=True)
+    status = Column(String(128), primary_key=True)
+    task_id = Column(BigIntId, nullable=False, index=True)
+    updated_at = Column(DateTime)
+
+
+def _insert(dialect_name: str):
+    if dialect_name == "mysql":
+        return mysql.insert(LatestSyncTask)
+    if dialect_name == "sqlite":
+        return sqlite.insert(LatestSyncTask)
+    raise NotImplementedError(f"Don't know how to upsert in {dialect_name}")
+
+
+async def refresh_latest_sync_tasks(db: "AsyncSession", task_ids: typing.Iterable[int]):
+    """
+    Copy the current status of 'task_ids' into latest_sync_tasks (in db's transaction).
+    A task only shows up under its current status: a meeting has at most one task in
+    progress at a time, so dropping the task's previous entry never hides an older task
+    that should be shown instead.
+    """
+    task_ids = list(task_ids)
+    if not task_ids:
+        return
+    await db.execute(sa.delete(LatestSyncTask).where(LatestSyncTask.task_id.in_(task_ids)))
+
+    columns = ["user_id", "meeting_id", "status", "task_id", "updated_at"]
+    current = sa.select(
+        SyncTask.user_id, SyncTask.meeting_id, SyncTask.status, SyncTask.id, SyncTask.updated_at
+    ).where(SyncTask.id.in_(task_ids))
+    stmt = _insert(db.bind.dialect.name).from_select(columns, current)
+    if db.bind.dialect.name == "mysql":
+        stmt = stmt.on_duplicate_key_update(
+            task_id=stmt.inserted.task_id, updated_at=stmt.inserted.updated_at
+        )
+    else:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["user_id", "meeting_id", "status"],
+            set_={"task_id": stmt.excluded.task_id, "updated_at": stmt.excluded.updated_at},
+        )
+    await db.execute(stmt)
@@ -0,0 +1,22 @@
+from datetime import datetime
+
+from sqlalchemy import Column, String, DateTime, Text
+
+from app.models.sync_task import BigIntId
+from tools.database import Base
+
+
+class OutboxMessage(Base):
+    """
+    Messages waiting to be published to Kafka. They are written in the same transaction as
+    the rows they talk about, and the outbox relay (worker/outbox_relay.py) publishes and
+    deletes them. That way a row never exists without its message (or vice versa).
+    """
+
+    __tablename__ = "outbox"
+
+    id = Column(BigIntId, primary_key=True)
+    topic = Column(String(128), nullable=False)
+    payload = Column(Text, nullable=False)
+    headers = Column(Text, nullable=True)  # JSON. Trace context and such (see tools.tracing)
+    created_at = Column(DateTime, default=datetime.utcnow)
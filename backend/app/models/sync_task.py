@@ -1,18 +1,33 @@
 from datetime import datetime
 
+import sqlalchemy as sa
 from sqlalchemy import Column, String, DateTime
 from sqlalchemy.dialects import mysql
 
 from tools.database import Base
 
+# Unsigned BIGINT in MySQL. SQLite (local testing) only auto-increments INTEGER primary keys.
+BigIntId = (
+    sa.BigInteger()
+    .with_variant(mysql.BIGINT(unsigned=True), "mysql")
+    .with_variant(sa.Integer(), "sqlite")
+)
+
 
 class SyncTask(Base):
     __tablename__ = "sync_tasks"
 
-    id = Column(mysql.BIGINT(unsigned=True), primary_key=True, index=True)
+    id = Column(BigIntId, primary_key=True, index=True)
     user_id = Column(String(128), index=True)  # Track user who started it
-    meeting_id = Column(mysql.BIGINT(unsigned=True), index=True)
+    meeting_id = Column(BigIntId, index=True)
     status = Column(String(128), default="scheduled")
+    # Goes up by one with every status change (see worker/status_writer.py), so clients can
+    # tell whether what they have is still the latest
+    status_version = Column(sa.Integer, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, index=True, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        # "Is there a task in progress for this user and meeting?" (see start_sync_task)
+        sa.Index("ix_sync_tasks_user_meeting_status", "user_id", "meeting_id", "status"),
+    )
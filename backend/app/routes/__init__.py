@@ -1 +1 @@
-from .sync_task import router as sync_task_router
\ No newline at end of file
+from .sync_task import router as sync_task_router
@@ -1,5 +1,10 @@
+import asyncio
 import copy
+import hashlib
 import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import jwt
@@ -21,19 +26,32 @@ token_url = "/login"
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=token_url)
 
 # Temporary user """database table""" (cough, cough). Just for testing!!
+# Passwords are pw_encryptor.hash_password(<username>), precomputed: bcrypt is (on purpose)
+# way too slow to run at import time.
 users_db = {
     "hector": {
         "username": "hector",
-        "password": pw_encryptor.hash_password("hector"),
+        "password": "$2b$12$xKAiaaR9GeXP///75IeP4.DssF0qEnVj4XXVIi.wn1JoJLsT5xIXq",
         "permissions": {"can_manually_sync": True},
     },
     "foo": {
         "username": "foo",
-        "password": pw_encryptor.hash_password("foo"),
+        "password": "$2b$12$bnX5lBpdXqrh7m9UQwJG0u94B.yIVLbP0fakIEPgkcyYJTOt4ACfm",
         "permissions": {"can_manually_sync": False},
     },
 }
 
+# bcrypt is CPU heavy. Logins get a small pool of their own, so a burst of them can't take
+# over the event loop (or the threads every other sync endpoint needs)
+_bcrypt_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BCRYPT_WORKERS", default="4")), thread_name_prefix="bcrypt"
+)
+
+# sha256(token) to (public user, token's exp timestamp), least recently used first.
+# Only tokens that were successfully verified get here.
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", default="10000"))
+_verified_tokens: OrderedDict[bytes, tuple[dict, float]] = OrderedDict()
+
 
 def _create_access_token(user: dict, expires_delta: timedelta = None):
     """Generate a short-lived access token."""
@@ -48,10 +66,13 @@ def _create_access_token(user: dict, expires_delta: timedelta = None):
 
 
 @router.post(token_url)
-def login(form_data: OAuth2PasswordRequestForm = Depends()):
+async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     """Login user and return access token (no refresh token for simplicity)."""
     user = users_db.get(form_data.username)  # User or None
-    if not user or not pw_encryptor.verify_password(form_data.password, user.get("password")):
+    valid_password = user and await asyncio.get_running_loop().run_in_executor(
+        _bcrypt_pool, pw_encryptor.verify_password, form_data.password, user.get("password")
+    )
+    if not valid_password:
         # Do NOT treat separately a user not found or a bad password. Huackers! Huackers!!!!
         raise HTTPException(
             status_code=http_status.HTTP_400_BAD_REQUEST, detail="Invalid username or password"
@@ -61,15 +82,40 @@ def login(form_data: OAuth2PasswordRequestForm = Depends()):
     return {"access_token": access_token, "refresh_token": None, "token_type": "bearer"}
 
 
+def _cached_user(token_digest: bytes) -> dict | None:
+    """The user of an already verified (and not expired yet) token, if we have it."""
+    entry = _verified_tokens.get(token_digest)
+    if entry is None:
+        return None
+    user, exp = entry
+    if exp <= time.time():
+        _verified_tokens.pop(token_digest, None)
+        return None
+    _verified_tokens.move_to_end(token_digest)
+    return user
+
+
+def _cache_user(token_digest: bytes, user: dict, exp: float):
+    _verified_tokens[token_digest] = (user, exp)
+    _verified_tokens.move_to_end(token_digest)
+    while len(_verified_tokens) > TOKEN_CACHE_SIZE:
+        _verified_tokens.popitem(last=False)
+
+
 # Meh... typical usage having a /me endpoint. We will probably not use it but...
 @router.get("/me")
-def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(token: str = Depends(oauth2_scheme)):
     """Decode token and return user info."""
+    token_digest = hashlib.sha256(token.encode()).digest()
+    user = _cached_user(token_digest)
+    if user is not None:
+        return {**user, "permissions": dict(user["permissions"])}  # Callers can't spoil the cache
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user = users_db[payload["sub"]]
         user = copy.deepcopy(user)
         user.pop("password", None)
+        _cache_user(token_digest, copy.deepcopy(user), float(payload["exp"]))
         return user
     except jwt.InvalidSignatureError:
         log.warning("Possible JWT tampering detected. Invalid signature.")
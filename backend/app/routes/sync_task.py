@@ -1,61 +1,98 @@
-import asyncio
+import base64
 import json
-from typing import Type, Iterable
+import os
+from datetime import datetime
 
 import sqlalchemy as sa
 import structlog
 from fastapi import APIRouter
-from fastapi import Depends, HTTPException
+from fastapi import Body, Depends, Header, HTTPException, Query, Response
 from fastapi import WebSocket
 from fastapi import status as http_status
-from sqlalchemy.orm import Session
-from starlette.websockets import WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.models import SyncTask
+from app.models import SyncTask, OutboxMessage, LatestSyncTask, refresh_latest_sync_tasks
+from app.models import ArchivedSyncTask
 from app.routes.auth import get_current_user
-from tools import constants, util_redis
-from tools.database import get_db
-from tools.kafka import produce_message
-from .sync_task_websocket import active_websockets
+from tools import constants, tracing, util_redis
+from tools.database import actx_db, actx_read_db, get_async_db, get_async_read_db
+from .sync_task_websocket import StatusWatcher, connections, subscriptions
 
 router = APIRouter()  # No prefix. Better be implicit on each route.
 
 log = structlog.get_logger()
 
+# How often an idle server-sent events stream gets a comment (to keep it open)
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", default="15"))
+# GET /sync's page size, when it's asked for the next page ('after') without a 'limit'
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE", default="500"))
+# How many meetings POST /sync/batch takes at once
+SYNC_BATCH_MAX_MEETINGS = int(os.getenv("SYNC_BATCH_MAX_MEETINGS", default="1000"))
+
+
+def _encode_cursor(entry: LatestSyncTask) -> str:
+    raw = json.dumps([entry.meeting_id, entry.status]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def _decode_cursor(cursor: str) -> tuple[int, str]:
+    try:
+        meeting_id, status = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return int(meeting_id), str(status)
+    except Exception:
+        raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail="Bad cursor")
+
 
 @router.get("/sync")
-def get_user_syncs(user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_user_syncs(
+    response: Response,
+    after: str | None = None,
+    limit: int | None = Query(default=None, ge=1, le=1000),
+    user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_read_db),
+):
     """
     Return the most recent sync tasks created by the logged in user ('user' param)
     deduplicated by meeting_id/status. Meaning: if we have two sync tasks for a given
     meeting both with the same status, it will return only the most recent one.
+    Those are kept in the latest_sync_tasks table, so this doesn't depend on how many tasks
+    the user ran in the past.
+    With 'limit' (or 'after'), results come in pages of (at most) 'limit' entries
+    (SYNC_PAGE_SIZE by default). If there are more, the X-Next-Cursor response header holds
+    what to pass as 'after' to get the next page. Without either, it's all of them.
+    It reads from a replica (if there are any), so a task started a moment ago may take a
+    moment to show up.
     """
-    subq = (
-        db.query(
-            SyncTask.id,
-            sa.func.row_number()
-            .over(
-                partition_by=[SyncTask.meeting_id, SyncTask.status],
-                order_by=SyncTask.updated_at.desc(),
-            )
-            .label("row_num"),
-        )
-        .filter(SyncTask.user_id == user["username"])
-        .subquery()
-    )
-    latest_entries: Iterable[Type[SyncTask]]
-    latest_entries = (
-        db.query(SyncTask).join(subq, SyncTask.id == subq.c.id).filter(subq.c.row_num == 1)
+    query = (
+        sa.select(LatestSyncTask)
+        .where(LatestSyncTask.user_id == user["username"])
+        .order_by(LatestSyncTask.meeting_id, LatestSyncTask.status)
     )
+    if limit is None and after:
+        limit = SYNC_PAGE_SIZE
+    if limit is not None:
+        query = query.limit(limit + 1)  # One more, to know if there's a next page
+    if after:
+        query = query.where(
+            sa.tuple_(LatestSyncTask.meeting_id, LatestSyncTask.status) > _decode_cursor(after)
+        )
+    latest_entries: list[LatestSyncTask] = list(await db.scalars(query))
+    if limit is not None and len(latest_entries) > limit:
+        latest_entries = latest_entries[:limit]
+        response.headers["X-Next-Cursor"] = _encode_cursor(latest_entries[-1])
     return [
-        {"task_id": st.id, "meeting_id": st.meeting_id, "status": st.status}
-        for st in latest_entries
+        {"task_id": lst.task_id, "meeting_id": lst.meeting_id, "status": lst.status}
+        for lst in latest_entries
     ]
 
 
 @router.post("/sync/{meeting_id}/start")
 async def start_sync_task(
-    meeting_id: int, user: dict = Depends(get_current_user), db: Session = Depends(get_db)
+    meeting_id: int,
+    meeting_version: str | None = Query(default=None, max_length=200),
+    user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Start a new sync task for the meeting with ID 'meeting_id' as long as we don't have
@@ -69,6 +106,10 @@ async def start_sync_task(
     as there isn't one currently "in progress" (not finished). We could easily change this
     to allow re-scheduling only for failed synchronization jobs, but for testing purposes,
     let's allow multiple re-syncs as long as the previous ones are all definitively finished.
+
+    'meeting_version' is the version of the meeting's data (like its updated_at), if the
+    caller knows it. With it, the stages can reuse what they did for that same version
+    instead of doing it again (see worker/stage_cache.py). Without it, they always run.
     """
     if not user["permissions"]["can_manually_sync"]:
         # 403: I know who you are, but you just can't do this... Dave https://youtu.be/5lsExRvJTAI
@@ -84,15 +125,15 @@ async def start_sync_task(
     # then throw an error. The frontend should prevent this from happening, by disabling
     # the <form> to create a new synchronization buuuUUuut... what did we just say about
     # the frontend? That we never ever trust it? Yeah...
-    existing_task = db.query(
-        db.query(SyncTask)
-        .filter(
-            SyncTask.meeting_id == meeting_id,
-            SyncTask.user_id == user["username"],
-            SyncTask.status.notin_(constants.finished_statuses),
+    existing_task = await db.scalar(
+        sa.select(
+            sa.exists().where(
+                SyncTask.meeting_id == meeting_id,
+                SyncTask.user_id == user["username"],
+                SyncTask.status.notin_(constants.finished_statuses),
+            )
         )
-        .exists()
-    ).scalar()
+    )
 
     if existing_task:
         raise HTTPException(
@@ -101,61 +142,290 @@ async def start_sync_task(
         )
 
     # Ok: If we're here, we can create a new synchronization task and send it to the Kafka
-    #     worker for processing.
+    #     worker for processing. The message goes to the outbox, in the same transaction as
+    #     the task: the outbox relay will publish it. No waiting for Kafka here.
     sync_task = SyncTask(meeting_id=meeting_id, user_id=user["username"])
     db.add(sync_task)
-    db.commit()
+    await db.flush()  # Get the ID
 
     task_data = {
         "task_id": sync_task.id,
         "meeting_id": sync_task.meeting_id,  # Nice to show the meetingID on the list of tasks
         "status": sync_task.status,
     }
+    if meeting_version is not None:
+        task_data["meeting_version"] = meeting_version
+    # The root of the task's trace: every hop after this one (stages, status updates...)
+    # hangs from it, and carries the task_id
+    with tracing.span("start_sync_task", baggage={"task_id": sync_task.id}):
+        db.add(
+            OutboxMessage(
+                topic=constants.start_topic,
+                payload=json.dumps(task_data),
+                headers=json.dumps(tracing.inject()),
+            )
+        )
+        await refresh_latest_sync_tasks(db, [sync_task.id])
+        await db.commit()
     log.info("Meeting synchronization task started", **task_data)
-    await produce_message(constants.start_topic, json.dumps(task_data))
     return task_data
 
 
-@router.get("/sync/{task_id}/status")
-def get_sync_status(
-    task_id: int, db: Session = Depends(get_db), user: dict = Depends(get_current_user)
+@router.post("/sync/batch")
+async def start_sync_tasks(
+    meeting_ids: list[int] = Body(embed=True, min_length=1, max_length=SYNC_BATCH_MAX_MEETINGS),
+    meeting_versions: dict[int, str] | None = Body(default=None, embed=True),
+    user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
-    Get the status of a sync task using "regular" periodic polling in the frontend.
-    We should rarely use this, since we have websockets, but just in case.
+    Like POST /sync/{meeting_id}/start, for many meetings at once (like a whole calendar):
+        {"meeting_ids": [1, 2, 3], "meeting_versions": {"1": "2024-05-01T10:00:00"}}
+    ('meeting_versions' is optional, and so is each meeting's: see 'meeting_version' there.)
+    Meetings with a sync in progress already are skipped. The answer has one entry per
+    meeting (in the order they came), either:
+        {"meeting_id": 1, "result": "started", "task_id": 123, "status": "scheduled"}
+        {"meeting_id": 2, "result": "conflict"}
+    It all happens with a handful of statements, whatever the number of meetings: one
+    query for the conflicts, one INSERT for the tasks (and one for their outbox messages,
+    which the outbox relay publishes in bulk) and one commit.
+    """
+    if not user["permissions"]["can_manually_sync"]:
+        raise HTTPException(
+            status_code=http_status.HTTP_403_FORBIDDEN,
+            detail=f"User {user['username']} can't manually sync",
+        )
+
+    meeting_ids = list(dict.fromkeys(meeting_ids))  # Same meeting twice? Just once
+    in_progress = set(
+        await db.scalars(
+            sa.select(SyncTask.meeting_id)
+            .where(
+                SyncTask.user_id == user["username"],
+                SyncTask.meeting_id.in_(meeting_ids),
+                SyncTask.status.notin_(constants.finished_statuses),
+            )
+            .distinct()
+        )
+    )
+    to_start = [meeting_id for meeting_id in meeting_ids if meeting_id not in in_progress]
+
+    task_ids: dict[int, int] = {}
+    if to_start:
+        now = datetime.utcnow()
+        await db.execute(
+            sa.insert(SyncTask),
+            [
+                {
+                    "meeting_id": meeting_id,
+                    "user_id": user["username"],
+                    "status": constants.scheduled_status,
+                    "created_at": now,
+                    "updated_at": now,
+                }
+                for meeting_id in to_start
+            ],
+        )
+        # Our new tasks are the only ones in progress for those meetings (MySQL can't
+        # RETURNING the IDs of a multi-row INSERT)
+        rows = await db.execute(
+            sa.select(SyncTask.meeting_id, SyncTask.id)
+            .where(
+                SyncTask.user_id == user["username"],
+                SyncTask.meeting_id.in_(to_start),
+                SyncTask.status == constants.scheduled_status,
+            )
+            .order_by(SyncTask.id)
+        )
+        task_ids = {meeting_id: task_id for meeting_id, task_id in rows}
+
+        outbox = []
+        with tracing.span("start_sync_tasks", meetings=len(to_start)):
+            for meeting_id in to_start:
+                task_data = {
+                    "task_id": task_ids[meeting_id],
+                    "meeting_id": meeting_id,
+                    "status": constants.scheduled_status,
+                }
+                if meeting_id in (meeting_versions or {}):
+                    task_data["meeting_version"] = meeting_versions[meeting_id]
+                with tracing.span("start_sync_task", baggage={"task_id": task_ids[meeting_id]}):
+                    headers = json.dumps(tracing.inject())
+                outbox.append(
+                    {
+                        "topic": constants.start_topic,
+                        "payload": json.dumps(task_data),
+                        "headers": headers,
+                        "created_at": now,
+                    }
+                )
+            await db.execute(sa.insert(OutboxMessage), outbox)
+            await refresh_latest_sync_tasks(db, task_ids.values())
+            await db.commit()
+    log.info(
+        "Meeting synchronization tasks started",
+        started=len(task_ids),
+        conflicts=len(in_progress),
+    )
+
+    results = []
+    for meeting_id in meeting_ids:
+        if meeting_id in task_ids:
+            results.append(
+                {
+                    "meeting_id": meeting_id,
+                    "result": "started",
+                    "task_id": task_ids[meeting_id],
+                    "status": constants.scheduled_status,
+                }
+            )
+        else:
+            results.append({"meeting_id": meeting_id, "result": "conflict"})
+    return results
+
+
+async def _read_status(task_id: int, user: dict, include_archived: bool = False) -> tuple[str, int]:
+    """
+    The (status, version) of the task, from the cache if possible. 404 if it's not there
+    (nor in the archive, with 'include_archived').
     """
 
     # First, query the best thing ever invented by mankind since chocolate milk (Redis)
     # which we're using as a cache. If we have queried the status before, we won't need
     # to go to the database.
-    redis_client = util_redis.get_client()
-    cache_key = util_redis.task_status_key(task_id)
-    if not redis_client.exists(cache_key):
-        log.info("Cache miss checking task status. Fetching from DB.", task_id=task_id)
-        sync_task = (
-            db.query(SyncTask.status)
-            .filter(SyncTask.id == task_id, SyncTask.user_id == user["username"])
-            .first()
+    async def load_status_from_db():
+        query = sa.select(SyncTask.status, SyncTask.status_version).where(
+            SyncTask.id == task_id, SyncTask.user_id == user["username"]
         )
-        # Even if the sync task was not found in the database, set a status in the
-        # Cache to ensure non-existing tasks don't pound our database
-        status = sync_task.status if sync_task else constants.not_found
-        redis_client.set(cache_key, status)
+        # Its own session: long-polls would otherwise keep a connection while they wait.
+        # From the primary, not a replica: what we read gets cached (for STATUS_TTL), and a
+        # replica that's behind would overwrite the fresher status the worker just cached
+        async with actx_read_db(read_your_writes=True) as db:
+            row = (await db.execute(query)).first()
+        return util_redis.encode_status(row.status, row.status_version) if row else None
 
-    status = redis_client.get(cache_key)
-    if status == constants.not_found:
+    # Even if the sync task was not found in the database, a (short lived) status is set
+    # in the cache to ensure non-existing tasks don't pound our database
+    value = await util_redis.read_through(
+        util_redis.task_status_key(task_id),
+        load_status_from_db,
+        negative_value=constants.not_found,
+    )
+    if value == constants.not_found:
+        archived = await _read_archived_status(task_id, user) if include_archived else None
+        if archived is not None:
+            return archived
         raise HTTPException(
             status_code=http_status.HTTP_404_NOT_FOUND,
             detail=f"No sync task found with id {task_id}",
         )
+    return util_redis.decode_status(value)
+
+
+async def _read_archived_status(task_id: int, user: dict) -> tuple[str, int] | None:
+    """
+    The (status, version) of an archived task (see worker/archiver.py), if it is one. Not
+    cached: it's opt-in, and the cache already says the task isn't in sync_tasks.
+    """
+    async with actx_read_db() as db:
+        row = (
+            await db.execute(
+                sa.select(ArchivedSyncTask.status, ArchivedSyncTask.status_version).where(
+                    ArchivedSyncTask.id == task_id, ArchivedSyncTask.user_id == user["username"]
+                )
+            )
+        ).first()
+    return (row.status, row.status_version) if row else None
+
+
+async def _watch_status(task_id: int, user: dict, status: str, version: int) -> StatusWatcher:
+    """Start following the status changes of the task (call subscriptions.remove when done)."""
+    watcher = StatusWatcher(status, version)
+    subscriptions.subscribe(watcher, [task_id])
+    # It might have changed between reading it and subscribing
+    status, version = await _read_status(task_id, user)
+    watcher.push_status(task_id, status, version)
+    return watcher
+
+
+@router.get("/sync/{task_id}/status")
+async def get_sync_status(
+    task_id: int,
+    wait: float | None = Query(None, ge=0, le=60),
+    since: int | None = None,
+    include_archived: bool = False,
+    user: dict = Depends(get_current_user),
+):
+    """
+    Get the status of a sync task using "regular" periodic polling in the frontend.
+    We should rarely use this, since we have websockets, but just in case.
+    Long polling: with 'since' (the version of the status the client already has) and 'wait',
+    the response comes as soon as there's a newer version, or after 'wait' seconds with the
+    same one. Either way, ask again with the version received.
+    Finished tasks are archived after a while (see worker/archiver.py): with
+    'include_archived', those are found too.
+    """
+    status, version = await _read_status(task_id, user, include_archived)
+    if wait and since is not None and version <= since:
+        if status not in constants.finished_statuses:  # Those won't change anymore
+            watcher = await _watch_status(task_id, user, status, version)
+            try:
+                if watcher.version <= since:
+                    await watcher.wait(wait)
+                status, version = watcher.status, watcher.version
+            finally:
+                subscriptions.remove(watcher)
 
     task_data = {
         "task_id": task_id,
         "status": status,
+        "version": version,
     }
     return task_data
 
 
+@router.get("/sync/{task_id}/status/events")
+async def sync_status_events(
+    task_id: int,
+    token: str,
+    since: int | None = None,
+    last_event_id: int | None = Header(None),
+):
+    """
+    Server-sent events with the status changes of a sync task, for those who can't use
+    websockets. 'token' is the access token (EventSource can't set headers). Each event's id
+    is the version of the status, so a reconnecting EventSource (which sends Last-Event-ID)
+    only gets what it missed. The stream ends once the task is finished.
+    """
+    user = await get_current_user(token)
+    since = last_event_id if last_event_id is not None else since
+    status, version = await _read_status(task_id, user)
+
+    async def events():
+        watcher = await _watch_status(task_id, user, status, version)
+        sent = -1 if since is None else since
+        try:
+            while True:
+                if watcher.version > sent:
+                    sent = watcher.version
+                    data = json.dumps(
+                        {"task_id": task_id, "status": watcher.status, "version": sent}
+                    )
+                    yield f"id: {sent}\nevent: status\ndata: {data}\n\n"
+                if watcher.status in constants.finished_statuses:
+                    return  # Nothing else will come
+                if not await watcher.wait(SSE_KEEPALIVE_SECONDS):
+                    yield ": keep-alive\n\n"  # Or proxies might think we're dead
+        finally:
+            subscriptions.remove(watcher)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.websocket("/ws/sync/{task_id}/status")
 async def sync_status_ws(websocket: WebSocket, task_id: int):
     """
@@ -163,13 +433,77 @@ async def sync_status_ws(websocket: WebSocket, task_id: int):
     This websocket will be used to push live sync status updates for the synchronization
     task with ID task_id to the frontend.
     Notice each task will have its own WebSocket. This could (potentially) lead to
-    port starvation. If that happens, we should
+    port starvation. Prefer /ws/sync, which can follow many tasks with one connection.
+    Like /ws/sync, it sends {"type": "ping"} every now and then, expecting an answer.
     """
     log.info("Opening websocket to track task", task_id=task_id)
-    await websocket.accept()
-    active_websockets[task_id] = websocket
+    connection = await connections.connect(websocket)
+    subscriptions.subscribe(connection, [task_id])
+    try:
+        # Nothing to do with what the client says (pongs). It just tells us it's alive.
+        while await connection.receive() is not None:
+            pass
+    finally:
+        await connections.disconnect(connection)
+
+
+async def _owned_task_ids(task_ids: list[int], user: dict) -> list[int]:
+    if not task_ids:
+        return []
+    async with actx_db() as db:
+        owned = await db.scalars(
+            sa.select(SyncTask.id).where(
+                SyncTask.id.in_(task_ids), SyncTask.user_id == user["username"]
+            )
+        )
+        return list(owned)
+
+
+@router.websocket("/ws/sync")
+async def sync_statuses_ws(websocket: WebSocket, token: str):
+    """
+    One websocket to follow the status of many sync tasks. 'token' is the access token
+    (browsers can't set headers on websockets). The client sends JSON messages:
+        {"action": "subscribe", "task_ids": [1, 2, 3]}
+        {"action": "unsubscribe", "task_ids": [2]}
+        {"action": "subscribe_all"}  (every task of the user, including the future ones)
+        {"action": "unsubscribe_all"}
+    and receives {"task_id": ..., "status": ...} whenever a followed task changes status.
+    Task IDs of other users are silently ignored.
+    Every now and then it also receives {"type": "ping"}, and should answer
+    {"action": "pong"} (or anything else): quiet clients are disconnected.
+    """
     try:
-        while True:
-            await asyncio.sleep(5)  # Keep connection alive
-    except WebSocketDisconnect:
-        active_websockets.pop(task_id, None)  # Safely (no exception) remove
+        user = await get_current_user(token)
+    except HTTPException:
+        await websocket.close(code=http_status.WS_1008_POLICY_VIOLATION)
+        return
+    connection = await connections.connect(websocket)
+    log.info("Opening multiplexed status websocket", user=user["username"])
+    try:
+        while (text := await connection.receive()) is not None:
+            try:
+                request = json.loads(text)
+                action = request["action"]
+                task_ids = [int(task_id) for task_id in request.get("task_ids", [])]
+            except (ValueError, TypeError, KeyError):
+                connections.send(connection, {"error": "Invalid request"})
+                continue
+
+            if action == "pong":
+                continue  # Heartbeat answer. Receiving it was all that mattered
+            elif action == "subscribe":
+                task_ids = await _owned_task_ids(task_ids, user)
+                subscriptions.subscribe(connection, task_ids)
+            elif action == "unsubscribe":
+                subscriptions.unsubscribe(connection, task_ids)
+            elif action == "subscribe_all":
+                subscriptions.subscribe_user(connection, user["username"])
+            elif action == "unsubscribe_all":
+                subscriptions.unsubscribe_user(connection)
+            else:
+                connections.send(connection, {"error": f"Unknown action {action!r}"})
+                continue
+            connections.send(connection, {"ack": action, "task_ids": task_ids})
+    finally:
+        await connections.disconnect(connection)
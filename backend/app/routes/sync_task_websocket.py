@@ -1,34 +1,352 @@
-import json
+import asyncio
+import os
+import socket
+import time
+from collections import defaultdict, deque
 
 import structlog
+from fastapi import status as http_status
 from starlette.websockets import WebSocket, WebSocketDisconnect, WebSocketState
 
-from tools import constants
+from tools import constants, envelope, metrics, util_redis
 from tools.kafka import consume_messages
 
 log = structlog.get_logger()
 
-active_websockets: dict[int, WebSocket] = {}  # SyncTask.ID to Websocket
+# How status updates reach this backend replica (there might be many behind a load balancer):
+# - "kafka": every replica reads the whole status_updates topic (in its own consumer group)
+# - "redis": every replica subscribes only to the pub/sub channels of the tasks (and users)
+#   its websockets follow
+STATUS_FANOUT = os.getenv("STATUS_FANOUT", default="kafka")
 
 
-async def _push_task_status(task_id: int, status: str):
+class Connection:
     """
-    Push a new status to the tasks's active websocket (if the websocket exists and it's active)
+    One websocket and what's waiting to be sent through it. Statuses are coalesced: if a task
+    changes twice before we get to send the first change, only the latest status is sent.
     """
 
-    # Push to WebSocket if active
-    websocket = active_websockets.get(task_id)
-    if websocket and websocket.client_state == WebSocketState.CONNECTED:
+    def __init__(self, websocket: WebSocket, max_pending: int):
+        self.websocket = websocket
+        self.max_pending = max_pending
+        self.last_seen = time.monotonic()
+        self.sender: asyncio.Task | None = None
+        # Task ID to its latest (not sent yet) status and version
+        self._statuses: dict[int, tuple[str, int | None]] = {}
+        self._messages: deque[dict] = deque()  # Anything else (acks, pings...), in order
+        self._wakeup = asyncio.Event()
+
+    def push_status(self, task_id: int, status: str, version: int | None = None) -> bool:
+        """Queue the status of the task. False if the client is too far behind to take it."""
+        if task_id not in self._statuses and len(self._statuses) >= self.max_pending:
+            return False
+        self._statuses[task_id] = (status, version)
+        self._wakeup.set()
+        return True
+
+    def send(self, message: dict) -> bool:
+        if len(self._messages) >= self.max_pending:
+            return False
+        self._messages.append(message)
+        self._wakeup.set()
+        return True
+
+    async def receive(self) -> str | None:
+        """Next message from the client, or None once it's gone (or we closed it)."""
         try:
-            log.info(
-                f"Pushing status update for task via websocket", task_id=task_id, status=status
-            )
-            await websocket.send_json({"task_id": task_id, "status": status})
+            text = await self.websocket.receive_text()
         except WebSocketDisconnect:
-            log.warning(f"WebSocket disconnected for sync task", task_id=task_id)
-            active_websockets.pop(task_id, None)
+            return None
+        except RuntimeError:  # We closed it (see ConnectionManager.disconnect)
+            return None
+        self.last_seen = time.monotonic()
+        return text
+
+    async def send_pending(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._messages or self._statuses:
+                if self._messages:
+                    await self.websocket.send_json(self._messages.popleft())
+                    continue
+                # One at a time: statuses arriving meanwhile still get coalesced
+                task_id = next(iter(self._statuses))
+                status, version = self._statuses.pop(task_id)
+                message = {"task_id": task_id, "status": status}
+                if version is not None:
+                    message["version"] = version
+                await self.websocket.send_json(message)
+
+
+class ConnectionManager:
+    """
+    Every status websocket of this replica. Each connection gets its own sender task, so
+    pushing a status never waits for the network (a slow client only slows itself down), and
+    one heartbeat task pings them all, evicting the ones that stopped answering.
+    """
+
+    def __init__(self):
+        self.heartbeat_seconds = float(os.getenv("WS_HEARTBEAT_SECONDS", default="15"))
+        self.idle_timeout_seconds = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", default="45"))
+        self.max_pending = int(os.getenv("WS_MAX_PENDING", default="1000"))
+        self.connections: set[Connection] = set()
+        self._heartbeat: asyncio.Task | None = None
+        self._closing: set[asyncio.Task] = set()
+
+    async def connect(self, websocket: WebSocket) -> Connection:
+        await websocket.accept()
+        connection = Connection(websocket, self.max_pending)
+        connection.sender = asyncio.create_task(self._run_sender(connection))
+        self.connections.add(connection)
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.create_task(self._run_heartbeat())
+        return connection
+
+    async def disconnect(
+        self, connection: Connection, code: int = http_status.WS_1000_NORMAL_CLOSURE
+    ):
+        # Always: it might have subscribed to something while being evicted
+        subscriptions.remove(connection)
+        if connection not in self.connections:
+            return  # Already done
+        self.connections.discard(connection)
+        if connection.sender is not asyncio.current_task():
+            connection.sender.cancel()
+        if connection.websocket.application_state == WebSocketState.CONNECTED:
+            try:
+                await connection.websocket.close(code=code)
+            except Exception:
+                pass  # It's gone anyway
+
+    def push_status(self, connection: Connection, task_id: int, status: str, version=None):
+        if not connection.push_status(task_id, status, version):
+            log.warning("Websocket client too far behind. Dropping it", task_id=task_id)
+            websocket_evictions.inc(reason="slow")
+            self._evict(connection, http_status.WS_1013_TRY_AGAIN_LATER)
+
+    def send(self, connection: Connection, message: dict):
+        if not connection.send(message):
+            log.warning("Websocket client too far behind. Dropping it")
+            websocket_evictions.inc(reason="slow")
+            self._evict(connection, http_status.WS_1013_TRY_AGAIN_LATER)
+
+    def _evict(self, connection: Connection, code: int):
+        task = asyncio.create_task(self.disconnect(connection, code))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _run_sender(self, connection: Connection):
+        try:
+            await connection.send_pending()
+        except asyncio.CancelledError:
+            raise
         except Exception:
-            log.exception("Exception updating status via websocket", task_id=task_id)
+            log.info("Couldn't send through websocket. Dropping it", exc_info=True)
+            websocket_evictions.inc(reason="send_error")
+            await self.disconnect(connection, http_status.WS_1011_INTERNAL_ERROR)
+
+    async def _run_heartbeat(self):
+        """
+        Clients are expected to answer the pings (with anything, like {"action": "pong"}).
+        The ones we haven't heard from in WS_IDLE_TIMEOUT_SECONDS are dead (or as good as).
+        """
+        while self.connections:
+            await asyncio.sleep(self.heartbeat_seconds)
+            idle_since = time.monotonic() - self.idle_timeout_seconds
+            for connection in list(self.connections):
+                if connection.last_seen < idle_since:
+                    log.info("Evicting idle websocket")
+                    websocket_evictions.inc(reason="idle")
+                    self._evict(connection, http_status.WS_1001_GOING_AWAY)
+                else:
+                    self.send(connection, {"type": "ping"})
+
+
+class StatusWatcher:
+    """
+    Follows a single task for a long-poll or server-sent events request. It only keeps the
+    latest status (a watcher never falls behind), and ignores the ones older than that.
+    """
+
+    def __init__(self, status: str, version: int):
+        self.status = status
+        self.version = version
+        self._changed = asyncio.Event()
+
+    def push_status(self, task_id: int, status: str, version: int | None = None) -> bool:
+        if version is not None and version <= self.version:
+            return True  # Old news (or a redelivery)
+        self.status = status
+        self.version = version if version is not None else self.version + 1
+        self._changed.set()
+        return True
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait (up to 'timeout' seconds) for a newer status. True if it arrived."""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._changed.clear()
+        return True
+
+
+class StatusSubscriptions:
+    """
+    Who wants to hear about which task. A connection can follow many tasks (by task_id)
+    and/or every task of its user, and a task can be followed by many connections (several
+    tabs...). Long-poll and SSE requests follow their task with a StatusWatcher instead.
+    """
+
+    def __init__(self):
+        # Called with ("task", task_id) or ("user", user_id) when the first connection starts
+        # following it (on_follow) and when the last one stops (on_unfollow)
+        self.on_follow = None
+        self.on_unfollow = None
+        self.by_task: dict[int, set[Connection]] = defaultdict(set)
+        self.by_user: dict[str, set[Connection]] = defaultdict(set)  # "All my tasks"
+        self._tasks_of: dict[Connection, set[int]] = defaultdict(set)
+        self._user_of: dict[Connection, str] = {}
+
+    def subscribe(self, connection: Connection, task_ids):
+        for task_id in task_ids:
+            if task_id not in self.by_task and self.on_follow:
+                self.on_follow("task", task_id)
+            self.by_task[task_id].add(connection)
+            self._tasks_of[connection].add(task_id)
+
+    def unsubscribe(self, connection: Connection, task_ids):
+        for task_id in task_ids:
+            self._discard(self.by_task, "task", task_id, connection)
+            self._tasks_of[connection].discard(task_id)
+
+    def subscribe_user(self, connection: Connection, user_id: str):
+        self.unsubscribe_user(connection)
+        if user_id not in self.by_user and self.on_follow:
+            self.on_follow("user", user_id)
+        self.by_user[user_id].add(connection)
+        self._user_of[connection] = user_id
+
+    def unsubscribe_user(self, connection: Connection):
+        user_id = self._user_of.pop(connection, None)
+        if user_id is not None:
+            self._discard(self.by_user, "user", user_id, connection)
+
+    def remove(self, connection: Connection):
+        """Forget everything about 'connection' (it's gone)."""
+        self.unsubscribe(connection, list(self._tasks_of.pop(connection, ())))
+        self.unsubscribe_user(connection)
+
+    def subscribers(self, task_id: int, user_id: str | None = None) -> set[Connection]:
+        connections = set(self.by_task.get(task_id, ()))
+        if user_id is not None:
+            connections.update(self.by_user.get(user_id, ()))
+        return connections
+
+    def _discard(self, index: dict, kind: str, key, connection: Connection):
+        connections = index.get(key)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del index[key]
+                if self.on_unfollow:
+                    self.on_unfollow(kind, key)
+
+
+subscriptions = StatusSubscriptions()
+connections = ConnectionManager()
+
+websocket_evictions = metrics.counter(
+    "websocket_evictions_total", "Websockets we dropped (idle, slow or send_error)", ["reason"]
+)
+metrics.gauge("websocket_connections", "Open status websockets").set_function(
+    lambda: len(connections.connections)
+)
+metrics.gauge(
+    "status_followed_tasks", "Tasks followed by websockets, long polls or SSE streams"
+).set_function(lambda: len(subscriptions.by_task))
+
+
+def _push_task_status(
+    task_id: int,
+    status: str,
+    user_id: str | None = None,
+    version: int | None = None,
+    followers: set[Connection] = None,
+):
+    """
+    Queue a new status for every connection following the task (either the task itself or
+    all the tasks of its user), or just for 'followers' if given. Doesn't wait for the
+    network: each connection's sender takes it from there.
+    """
+    if followers is None:
+        followers = subscriptions.subscribers(task_id, user_id)
+    if not followers:
+        return
+    log.info(
+        f"Pushing status update for task via websocket",
+        task_id=task_id,
+        status=status,
+        websockets=len(followers),
+    )
+    for connection in followers:
+        connections.push_status(connection, task_id, status, version)
+
+
+class RedisStatusRelay:
+    """
+    Receives status updates through Redis pub/sub, subscribed only to the channels of the
+    tasks and users this replica's websockets follow (see StatusSubscriptions.on_follow).
+    """
+
+    def __init__(self):
+        self._pubsub = util_redis.get_async_client().pubsub(ignore_subscribe_messages=True)
+        self._channels: dict[str, tuple[str, int | str]] = {}  # Channel to (kind, key)
+        self._changes: set[asyncio.Task] = set()
+
+    def _channel(self, kind: str, key) -> str:
+        if kind == "task":
+            return util_redis.task_status_channel(key)
+        return util_redis.user_status_channel(key)
+
+    def follow(self, kind: str, key):
+        channel = self._channel(kind, key)
+        self._channels[channel] = (kind, key)
+        self._run_change(self._pubsub.subscribe(channel))
+
+    def unfollow(self, kind: str, key):
+        channel = self._channel(kind, key)
+        self._channels.pop(channel, None)
+        self._run_change(self._pubsub.unsubscribe(channel))
+
+    def _run_change(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._changes.add(task)
+        task.add_done_callback(self._changes.discard)
+
+    async def run(self):
+        while True:
+            if not self._pubsub.subscribed:
+                await asyncio.sleep(0.1)
+                continue
+            message = await self._pubsub.get_message(timeout=1.0)
+            if message is None or message["channel"] not in self._channels:
+                continue
+            kind, _key = self._channels[message["channel"]]
+            task_id = None
+            try:
+                data = envelope.decode(message["data"])  # JSON: see status_writer
+                task_id = int(data["task_id"])
+                followers = set(subscriptions.by_task.get(task_id, ()))
+                if kind == "user":
+                    # Those following the task itself get it through the task's channel
+                    followers = set(subscriptions.by_user.get(data["user_id"], ())) - followers
+                _push_task_status(
+                    task_id, data["status"], version=data.get("version"), followers=followers
+                )
+            except Exception:
+                log.exception("Exception handling notifications", sync_task_id=task_id)
 
 
 async def status_updates_listener():
@@ -38,11 +356,27 @@ async def status_updates_listener():
     The (sort-of) background task will be (or should be) started in FastAPI's main.py in a
     on_event("startup") to ensure it's running when the server boots.
     """
-    async for message in consume_messages(constants.status_updates_topic):
+    if STATUS_FANOUT == "redis":
+        relay = RedisStatusRelay()
+        subscriptions.on_follow, subscriptions.on_unfollow = relay.follow, relay.unfollow
+        for task_id in list(subscriptions.by_task):
+            relay.follow("task", task_id)
+        for user_id in list(subscriptions.by_user):
+            relay.follow("user", user_id)
+        log.info("Listening to status updates through Redis pub/sub")
+        await relay.run()
+        return
+
+    # Our own consumer group: every replica must see every update (not just "its share").
+    # Throwaway (a new one every start): from the latest update, and gone once we stop
+    group_id = f"status_ws_{socket.gethostname()}_{os.getpid()}"
+    async for message in consume_messages(
+        constants.status_updates_topic, group_id=group_id, ephemeral=True
+    ):
         task_id = None
         try:
-            data = json.loads(message)
+            data = envelope.decode(message)
             task_id = int(data["task_id"])  # Just in case... ensure it's an int
-            await _push_task_status(task_id, data["status"])
+            _push_task_status(task_id, data["status"], data.get("user_id"), data.get("version"))
         except Exception:
             log.exception("Exception handling notifications", sync_task_id=task_id)
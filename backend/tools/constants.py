@@ -1,6 +1,8 @@
+scheduled_status = "scheduled"
 completed_status = "completed"
 failed_status = "failed"
 finished_statuses = [completed_status, failed_status]
 start_topic = "jobA"
 status_updates_topic = "status_updates"
+dead_letter_topic = "dead_letters"  # Stage messages that ran out of retries (worker/retries.py)
 not_found = "Not Found"  # Assume none of the SyncTask.status will be "Not Found"
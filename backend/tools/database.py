@@ -1,21 +1,194 @@
+import asyncio
+import contextvars
+import itertools
 import os
+import time
 import typing
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
 
-from sqlalchemy import create_engine
+import structlog
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from tools import metrics
+
 if typing.TYPE_CHECKING:
     from sqlalchemy.orm import Session
-    
+    from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+log = structlog.get_logger()
+
 DATABASE_URL = os.getenv("DATABASE_URL", default="mysql+pymysql://user:password@db:3306/fthm")
+# Read replicas (comma separated URLs, like DATABASE_URL's) for what can read slightly stale
+# data: see actx_read_db(). Empty: everything goes to the primary (DATABASE_URL)
+DATABASE_REPLICA_URLS = os.getenv("DATABASE_REPLICA_URLS", default="")
+# A replica that failed is left alone for this long (unless a health check says it's back)
+DB_REPLICA_RETRY_SECONDS = float(os.getenv("DB_REPLICA_RETRY_SECONDS", default="10"))
+# How often run_replica_health_checks() pings the replicas
+DB_REPLICA_CHECK_SECONDS = float(os.getenv("DB_REPLICA_CHECK_SECONDS", default="5"))
+# Pooled connections warm_up() opens, so the first requests don't pay for connecting
+DB_WARM_CONNECTIONS = int(os.getenv("DB_WARM_CONNECTIONS", default="2"))
+
+# Sync driver -> async driver for the same database. Use ASYNC_DATABASE_URL to override.
+_async_drivers = {
+    "mysql": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+
+def _to_async_url(url: str) -> str:
+    url = make_url(url)
+    return url.set(drivername=_async_drivers.get(url.drivername, url.drivername)).render_as_string(
+        hide_password=False
+    )
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or _to_async_url(DATABASE_URL)
+ASYNC_DATABASE_REPLICA_URLS = os.getenv("ASYNC_DATABASE_REPLICA_URLS") or ",".join(
+    _to_async_url(url.strip()) for url in DATABASE_REPLICA_URLS.split(",") if url.strip()
+)
+
+
+def _engine_kwargs(url: str, tier: str = "") -> dict:
+    """
+    Connection pool settings. SQLite (local testing) doesn't do real pooling, so it
+    only gets what it needs to be shared between threads.
+    The replicas' (tier "replica") are DB_REPLICA_POOL_SIZE, DB_REPLICA_MAX_OVERFLOW...
+    falling back to the primary's (DB_POOL_SIZE...), so each tier can be sized on its own.
+    """
+    if make_url(url).get_backend_name() == "sqlite":
+        return {"connect_args": {"check_same_thread": False}}
+
+    def setting(name: str, default: str) -> int:
+        prefix = f"DB_{tier.upper()}_" if tier else "DB_"
+        return int(os.getenv(prefix + name) or os.getenv(f"DB_{name}", default=default))
+
+    return {
+        "pool_size": setting("POOL_SIZE", "10"),
+        "max_overflow": setting("MAX_OVERFLOW", "20"),
+        "pool_recycle": setting("POOL_RECYCLE", "1800"),  # MySQL drops idle conns
+        "pool_timeout": setting("POOL_TIMEOUT", "10"),
+        "pool_pre_ping": True,
+    }
+
+
+db_query_seconds = metrics.histogram(
+    "db_query_seconds", "Statement execution time", ["engine", "statement"]
+)
+db_connections_checked_out = metrics.gauge(
+    "db_connections_checked_out", "Pooled connections in use", ["engine"]
+)
+db_reads = metrics.counter(
+    "db_reads_total", "Read sessions, by where they went (a replica, or primary)", ["target"]
+)
+
+
+def _instrument(sync_engine, name: str):
+    """Time every statement (by its verb: SELECT, UPDATE...) and count connections in use."""
 
-engine = create_engine(DATABASE_URL)
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_started_at = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started_at = getattr(context, "_metrics_started_at", None)
+        if started_at is not None:
+            verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+            db_query_seconds.observe(time.perf_counter() - started_at, engine=name, statement=verb)
+
+    @event.listens_for(sync_engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        db_connections_checked_out.inc(engine=name)
+
+    @event.listens_for(sync_engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        db_connections_checked_out.dec(engine=name)
+
+
+engine = create_engine(DATABASE_URL, **_engine_kwargs(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_engine_kwargs(ASYNC_DATABASE_URL))
+# Don't expire on commit: with async sessions, lazy-reloading an attribute after the
+# commit would need an await we can't do on attribute access.
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+_instrument(engine, "sync")
+_instrument(async_engine.sync_engine, "async")
 Base = declarative_base()
 
 
+class Replica:
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.engine: "AsyncEngine" = create_async_engine(url, **_engine_kwargs(url, "replica"))
+        self.sessionmaker = async_sessionmaker(
+            bind=self.engine, autoflush=False, expire_on_commit=False
+        )
+        self.down_until = 0.0
+        _instrument(self.engine.sync_engine, name)
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def mark_down(self, error: Exception):
+        if self.healthy:
+            log.warning("Database replica is down", replica=self.name, error=repr(error))
+        self.down_until = time.monotonic() + DB_REPLICA_RETRY_SECONDS
+
+    def mark_up(self):
+        if not self.healthy:
+            log.info("Database replica is back", replica=self.name)
+        self.down_until = 0.0
+
+
+class ReplicaSet:
+    """The read replicas, taking turns (round-robin), skipping the ones that are down."""
+
+    def __init__(self, urls: list[str]):
+        self.replicas = [Replica(f"replica{i}", url) for i, url in enumerate(urls)]
+        self._turns = itertools.count()
+
+    def choose(self) -> list[Replica]:
+        """The healthy replicas, in the order to try them (starting with whose turn it is)."""
+        if not self.replicas:
+            return []
+        start = next(self._turns) % len(self.replicas)
+        ordered = self.replicas[start:] + self.replicas[:start]
+        return [replica for replica in ordered if replica.healthy]
+
+    async def check(self):
+        """Ping every replica, marking them up or down."""
+
+        async def check_one(replica: Replica):
+            try:
+                async with replica.engine.connect() as conn:
+                    await conn.execute(text("SELECT 1"))
+            except Exception as e:
+                replica.mark_down(e)
+            else:
+                replica.mark_up()
+
+        await asyncio.gather(*(check_one(replica) for replica in self.replicas))
+
+
+replicas = ReplicaSet(
+    [url.strip() for url in ASYNC_DATABASE_REPLICA_URLS.split(",") if url.strip()]
+)
+
+# Set by read_your_writes(): read sessions go to the primary
+_reading_own_writes: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "reading_own_writes", default=False
+)
+
+
 @contextmanager
 def ctx_db() -> "Session":
     """Context manager for database session."""
@@ -30,3 +203,90 @@ def get_db() -> "Session":
     """Generator for FastAPI dependency, reusing ctx_db()."""
     with ctx_db() as db:
         yield db
+
+
+@asynccontextmanager
+async def actx_db() -> "AsyncSession":
+    """Async context manager for database session (the async sibling of ctx_db)."""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_async_db() -> "AsyncSession":
+    """Async generator for FastAPI dependency, reusing actx_db()."""
+    async with actx_db() as db:
+        yield db
+
+
+@contextmanager
+def read_your_writes():
+    """
+    Within it, read sessions (actx_read_db) go to the primary. For code that must see what
+    was just committed, which a replica might not have yet.
+    """
+    token = _reading_own_writes.set(True)
+    try:
+        yield
+    finally:
+        _reading_own_writes.reset(token)
+
+
+@asynccontextmanager
+async def actx_read_db(read_your_writes: bool = False) -> "AsyncSession":
+    """
+    Like actx_db(), for reading only: the session goes to a replica (see
+    DATABASE_REPLICA_URLS), so reads don't compete with writes on the primary. Their data can
+    be a bit behind: with 'read_your_writes' (or within read_your_writes()), or when there
+    are no replicas or none of them answers, it goes to the primary instead.
+    """
+    if not (read_your_writes or _reading_own_writes.get()):
+        for replica in replicas.choose():
+            db = replica.sessionmaker()
+            try:
+                await db.connection()  # Checked out (and pinged) now: a dead one is skipped
+            except Exception as e:
+                await db.close()
+                replica.mark_down(e)
+                continue
+            db_reads.inc(target=replica.name)
+            async with db:
+                yield db
+            return
+    db_reads.inc(target="primary")
+    async with actx_db() as db:
+        yield db
+
+
+async def get_async_read_db() -> "AsyncSession":
+    """Async generator for FastAPI dependency, reusing actx_read_db(). For read-only routes."""
+    async with actx_read_db() as db:
+        yield db
+
+
+async def ping():
+    """Raise if the database doesn't answer (through the async pool)."""
+    async with async_engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+
+async def run_replica_health_checks():
+    """Check the replicas every DB_REPLICA_CHECK_SECONDS, forever (if there are any)."""
+    while replicas.replicas:
+        await replicas.check()
+        await asyncio.sleep(DB_REPLICA_CHECK_SECONDS)
+
+
+async def warm_up(connections: int = DB_WARM_CONNECTIONS):
+    """
+    Open 'connections' connections of the async pool (all at once, so they're different
+    ones) and give them back to it. Meant to run in the background when a process starts.
+    """
+    opened = []
+    try:
+        for _ in range(max(connections, 1)):
+            conn = await async_engine.connect()
+            opened.append(conn)
+            await conn.execute(text("SELECT 1"))
+    finally:
+        for conn in opened:
+            await conn.close()
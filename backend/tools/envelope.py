@@ -0,0 +1,180 @@
+"""
+Versioned envelope for the pipeline messages: the tasks going through jobA/jobB/jobC and
+the status_updates. MESSAGE_FORMAT picks what producers write:
+- "binary" (default): the struct layout below, with the statuses interned as 1 byte codes
+- "json": the original JSON. Use it while consumers older than this module still run.
+decode() reads both, so consumers can always be rolled out first.
+
+Binary layout (little endian):
+    magic (0xF7: never the first byte of JSON) | layout version (1) | kind | body
+    task (kind 1):          task_id u64 | meeting_id u64 | status [| meeting_version | result]
+    status update (kind 2): task_id u64 | version u32 | status | user_id
+A task's meeting_version (the version of the meeting's data it syncs) and result (the
+previous stage's, as JSON) are optional, trailing strings: decoders that don't know about
+them just ignore them. They're only in the dict when set.
+'status' is its code in STATUSES (a u8), or 0xFF followed by the string if it's not there.
+Strings are a u16 length and the UTF-8 bytes (length 0xFFFF: None). None numbers are stored
+as their type's max value.
+"""
+
+import json
+import os
+import struct
+
+MESSAGE_FORMAT = os.getenv("MESSAGE_FORMAT", default="binary")
+
+MAGIC = 0xF7
+LAYOUT_VERSION = 1
+TASK, STATUS_UPDATE = 1, 2
+
+# Append only! Codes go on the wire: never reorder or remove (code = index + 1)
+STATUSES = ["scheduled", "jobA", "jobB", "jobC", "completed", "failed"]
+_status_codes = {status: code for code, status in enumerate(STATUSES, start=1)}
+_NOT_INTERNED = 0xFF
+
+_header = struct.Struct("<BBB")
+_task = struct.Struct("<QQ")
+_status_update = struct.Struct("<QI")
+_length = struct.Struct("<H")
+_NONE_U64, _NONE_U32, _NONE_LENGTH = 2**64 - 1, 2**32 - 1, 0xFFFF
+
+
+def encode_task(
+    task_id: int,
+    meeting_id: int | None,
+    status: str,
+    meeting_version: str | None = None,
+    result: str | None = None,
+) -> bytes | str:
+    """A task message for the jobA/jobB/jobC topics."""
+    if MESSAGE_FORMAT == "json":
+        data = {"task_id": task_id, "meeting_id": meeting_id, "status": status}
+        if meeting_version is not None:
+            data["meeting_version"] = meeting_version
+        if result is not None:
+            data["result"] = result
+        return json.dumps(data)
+    parts = [
+        _header.pack(MAGIC, LAYOUT_VERSION, TASK),
+        _task.pack(task_id, _NONE_U64 if meeting_id is None else meeting_id),
+        _pack_status(status),
+    ]
+    if meeting_version is not None or result is not None:
+        parts += [_pack_str(meeting_version), _pack_str(result)]
+    return b"".join(parts)
+
+
+def encode_status_update(
+    task_id: int, status: str, version: int | None, user_id: str | None
+) -> bytes | str:
+    """A message for the status_updates topic."""
+    if MESSAGE_FORMAT == "json":
+        return json.dumps(
+            {"task_id": task_id, "status": status, "version": version, "user_id": user_id}
+        )
+    return b"".join(
+        (
+            _header.pack(MAGIC, LAYOUT_VERSION, STATUS_UPDATE),
+            _status_update.pack(task_id, _NONE_U32 if version is None else version),
+            _pack_status(status),
+            _pack_str(user_id),
+        )
+    )
+
+
+def decode(payload: bytes | str) -> dict:
+    """
+    The message as a dict (the same one its JSON would give), whatever format it came in.
+    Raises ValueError if it can't be decoded.
+    """
+    if isinstance(payload, str):
+        return json.loads(payload)
+    if not payload or payload[0] != MAGIC:
+        return json.loads(payload)  # Legacy (or MESSAGE_FORMAT=json) message
+
+    try:
+        _magic, layout_version, kind = _header.unpack_from(payload, 0)
+        if layout_version != LAYOUT_VERSION:
+            raise ValueError(f"Unknown message layout version {layout_version}")
+        offset = _header.size
+        if kind == TASK:
+            task_id, meeting_id = _task.unpack_from(payload, offset)
+            status, offset = _unpack_status(payload, offset + _task.size)
+            data = {
+                "task_id": task_id,
+                "meeting_id": None if meeting_id == _NONE_U64 else meeting_id,
+                "status": status,
+            }
+            if offset < len(payload):
+                meeting_version, offset = _unpack_str(payload, offset)
+                result, offset = _unpack_str(payload, offset)
+                if meeting_version is not None:
+                    data["meeting_version"] = meeting_version
+                if result is not None:
+                    data["result"] = result
+            return data
+        if kind == STATUS_UPDATE:
+            task_id, version = _status_update.unpack_from(payload, offset)
+            status, offset = _unpack_status(payload, offset + _status_update.size)
+            user_id, _offset = _unpack_str(payload, offset)
+            return {
+                "task_id": task_id,
+                "status": status,
+                "version": None if version == _NONE_U32 else version,
+                "user_id": user_id,
+            }
+    except struct.error as e:
+        raise ValueError(f"Truncated message: {e}") from e
+    raise ValueError(f"Unknown message kind {kind}")
+
+
+def transcode(payload: bytes | str) -> bytes | str:
+    """
+    'payload' (in whatever format) in the MESSAGE_FORMAT producers should write. For
+    messages written before they're produced, like the outbox ones (which are JSON).
+    """
+    data = decode(payload)
+    if "meeting_id" in data:
+        return encode_task(
+            data["task_id"],
+            data["meeting_id"],
+            data["status"],
+            data.get("meeting_version"),
+            data.get("result"),
+        )
+    return encode_status_update(
+        data["task_id"], data["status"], data.get("version"), data.get("user_id")
+    )
+
+
+def _pack_status(status: str) -> bytes:
+    code = _status_codes.get(status)
+    if code is not None:
+        return bytes((code,))
+    return bytes((_NOT_INTERNED,)) + _pack_str(status)
+
+
+def _unpack_status(payload: bytes, offset: int) -> tuple[str, int]:
+    code = payload[offset]
+    if code == _NOT_INTERNED:
+        return _unpack_str(payload, offset + 1)
+    if not 1 <= code <= len(STATUSES):
+        raise ValueError(f"Unknown status code {code}")
+    return STATUSES[code - 1], offset + 1
+
+
+def _pack_str(value: str | None) -> bytes:
+    if value is None:
+        return _length.pack(_NONE_LENGTH)
+    encoded = value.encode("utf-8")
+    return _length.pack(len(encoded)) + encoded
+
+
+def _unpack_str(payload: bytes, offset: int) -> tuple[str | None, int]:
+    (length,) = _length.unpack_from(payload, offset)
+    offset += _length.size
+    if length == _NONE_LENGTH:
+        return None, offset
+    if offset + length > len(payload):
+        raise ValueError("Truncated message")
+    return payload[offset : offset + length].decode("utf-8"), offset + length
@@ -0,0 +1,102 @@
+"""
+Liveness and readiness of a process: the backend's /health/live and /health/ready, and
+job_runner's (served next to its /metrics, see http_routes).
+- live: the event loop answers. If it doesn't, restart the process.
+- ready: what it depends on is warm: the DB pool and Redis answer, the transport's producer
+  started and the consumers it runs joined their groups. Until then, send no traffic its way.
+Components report in with set_ready() (see warm_up, and the transports' consumers), and
+probes (a SELECT 1, a Redis PING...) run on every readiness check.
+"""
+
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Callable
+
+import structlog
+
+log = structlog.get_logger()
+
+PROBE_TIMEOUT_SECONDS = float(os.getenv("HEALTH_PROBE_TIMEOUT_SECONDS", default="2"))
+WARM_UP_MAX_BACKOFF_SECONDS = float(os.getenv("WARM_UP_MAX_BACKOFF_SECONDS", default="10"))
+
+_started_at = time.monotonic()
+_components: dict[str, bool] = {}
+_probes: dict[str, Callable[[], Awaitable]] = {}
+
+
+def expect(name: str):
+    """The process isn't ready until 'name' reports in with set_ready()."""
+    _components.setdefault(name, False)
+
+
+def set_ready(name: str, ready: bool = True):
+    _components[name] = ready
+
+
+def is_ready(name: str) -> bool:
+    return _components.get(name, False)
+
+
+def add_probe(name: str, probe: Callable[[], Awaitable]):
+    """Await probe() on every readiness check. Ready if it doesn't raise (or time out)."""
+    _probes[name] = probe
+
+
+async def warm_up(name: str, func: Callable[[], Awaitable]):
+    """
+    Await func() until it works (backing off in between), then mark 'name' as ready. For
+    what used to block (or crash) the start of the process when a dependency wasn't up yet.
+    """
+    expect(name)
+    started = time.perf_counter()
+    delay = 0.1
+    while True:
+        try:
+            await func()
+        except Exception as e:
+            log.warning("Couldn't warm up. Retrying", component=name, retry_in=delay, error=repr(e))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARM_UP_MAX_BACKOFF_SECONDS)
+        else:
+            set_ready(name)
+            log.info("Warmed up", component=name, seconds=round(time.perf_counter() - started, 3))
+            return
+
+
+async def _probe(name: str, probe: Callable[[], Awaitable]) -> bool:
+    try:
+        await asyncio.wait_for(probe(), PROBE_TIMEOUT_SECONDS)
+        return True
+    except Exception as e:
+        log.info("Readiness probe failed", probe=name, error=repr(e))
+        return False
+
+
+def liveness() -> dict:
+    return {"status": "ok", "uptime_s": round(time.monotonic() - _started_at, 3)}
+
+
+async def readiness() -> tuple[bool, dict[str, bool]]:
+    """(Whether the process is ready, and how each of its components and probes is doing)."""
+    checks = dict(_components)
+    names = list(_probes)
+    results = await asyncio.gather(*(_probe(name, _probes[name]) for name in names))
+    checks.update(zip(names, results))
+    return all(checks.values()), checks
+
+
+async def _live_route() -> tuple[str, str, bytes]:
+    return "200 OK", "application/json", json.dumps(liveness()).encode()
+
+
+async def _ready_route() -> tuple[str, str, bytes]:
+    ready, checks = await readiness()
+    body = json.dumps({"ready": ready, "checks": checks}).encode()
+    return "200 OK" if ready else "503 Service Unavailable", "application/json", body
+
+
+def http_routes() -> dict[str, Callable[[], Awaitable[tuple[str, str, bytes]]]]:
+    """Routes for processes without a web app (see tools.metrics.serve_metrics)."""
+    return {"/health/live": _live_route, "/health/ready": _ready_route}
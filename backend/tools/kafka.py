@@ -1,11 +1,41 @@
+import asyncio
 import os
+import time
 
 import structlog
-from aiokafka import AIOKafkaProducer, AIOKafkaConsumer
+from aiokafka import AIOKafkaProducer, AIOKafkaConsumer, ConsumerRebalanceListener, TopicPartition
+
+from tools import health, metrics, tracing
+from tools.transport import (
+    DEFAULT_GROUP_ID,
+    Handler,
+    HeadersHandler,
+    Payload,
+    Transport,
+    consumer_component,
+    log_send_result,
+)
 
 log = structlog.get_logger()
 
+messages_produced = metrics.counter("messages_produced_total", "Messages produced", ["topic"])
+message_handling_seconds = metrics.histogram(
+    "message_handling_seconds", "consume_concurrently handler time", ["topic"]
+)
+messages_in_flight = metrics.gauge(
+    "messages_in_flight", "consume_concurrently handlers running", ["topic"]
+)
+message_queue_seconds = metrics.histogram(
+    "message_queue_seconds", "From produced to consumed (waiting in the queue)", ["topic"]
+)
+consumer_lag = metrics.gauge(
+    "consumer_lag",
+    "Messages behind the end of the partition (Kafka)",
+    ["topic", "partition", "group"],
+)
+
 _kafka_broker = None
+_transport: Transport | None = None
 
 
 def get_kafka_broker():
@@ -15,41 +45,363 @@ def get_kafka_broker():
     return _kafka_broker
 
 
-async def produce_message(topic: str, message: str):
-    producer = AIOKafkaProducer(bootstrap_servers=get_kafka_broker())
-    await producer.start()
+def get_transport() -> Transport:
+    """The process-wide transport, picked with MESSAGE_TRANSPORT (see tools.transport)."""
+    global _transport
+    if _transport is None:
+        name = os.getenv("MESSAGE_TRANSPORT", default="kafka")
+        if name == "kafka":
+            _transport = KafkaTransport()
+        elif name == "memory":
+            from tools.memory_transport import MemoryTransport
+
+            _transport = MemoryTransport()
+        elif name == "redis":
+            from tools.redis_streams import RedisStreamsTransport
+
+            _transport = RedisStreamsTransport()
+        else:
+            raise ValueError(f"Unknown MESSAGE_TRANSPORT {name!r}")
+        log.info("Using message transport", transport=name)
+    return _transport
+
+
+async def start_producer():
+    """
+    Get the transport ready to produce. Meant to be called (through tools.health's warm_up)
+    from FastAPI's startup event or the worker's main(), but produce_message() will do it
+    lazily too, just in case.
+    """
+    await get_transport().start()
+    health.set_ready("producer")
+
+
+async def stop_producer():
+    """Flush whatever is still buffered and close the transport's producer."""
+    health.set_ready("producer", False)
+    await get_transport().stop()
+
+
+async def produce_message(
+    topic: str, message: Payload, wait: bool = True, headers: dict[str, str] | None = None
+):
+    """
+    Send 'message' to 'topic'.
+    With wait=True (the default) this returns once the broker acknowledged the message.
+    With wait=False the message is just appended to the producer's buffer and the
+    delivery future is returned (fire-and-forget). Errors are logged when it resolves.
+    The message carries the trace context and the time it was produced (see tools.tracing),
+    unless 'headers' (like the ones saved with an outbox message) say otherwise.
+    """
+    headers = {**tracing.inject(), **(headers or {})}
+    delivery = await get_transport().produce(topic, message, wait=wait, headers=headers)
+    messages_produced.inc(topic=topic)
+    return delivery
+
+
+async def consume_messages(
+    topic,
+    only_once=True,
+    group_id: str = DEFAULT_GROUP_ID,
+    with_headers: bool = False,
+    ephemeral: bool = False,
+):
+    """
+    Async iterator that yields the messages of 'topic' (or (message, headers) tuples, with
+    'with_headers').
+    With only_once, a message is acknowledged (its offset committed) once the caller is done
+    with it (when it asks for the next one), not before the caller even started working on it.
+    Without it, nothing is acknowledged.
+    An 'ephemeral' group is a throwaway one (like one per process): it starts from the latest
+    message and leaves nothing behind (see Transport.consume).
+    """
+    component = consumer_component(topic, group_id)
+    health.expect(component)  # Until the transport's consumer joined the group
     try:
-        await producer.send_and_wait(topic, message.encode("utf-8"))
-        await producer.flush()
-        log.info(f"Produced Kafka message", topic=topic, message=message)
-    except Exception:
-        log.exception("Error producing Kafka message", topic=topic, message=message)
-        raise
+        async for message, headers in get_transport().consume(
+            topic, group_id=group_id, only_once=only_once, ephemeral=ephemeral
+        ):
+            span = _consumed_span(topic, headers)
+            try:
+                yield (message, headers) if with_headers else message
+            finally:
+                span.end()
     finally:
-        await producer.stop()
-
-
-async def consume_messages(topic, only_once=True):
-    """Async generator that yields Kafka messages."""
-    group_id = "sync_group"
-    consumer = AIOKafkaConsumer(
-        topic,
-        bootstrap_servers=get_kafka_broker(),
-        group_id=group_id,
-        enable_auto_commit=False if only_once else True,
-    )
-    await consumer.start()
-    log.info("Starting consumer", topic=topic, group_id=group_id)
-    value = None
+        health.set_ready(component, False)
+
+
+async def consume_concurrently(
+    topic: str,
+    handler: Handler | HeadersHandler,
+    *,
+    max_in_flight: int = 1,
+    group_id: str = DEFAULT_GROUP_ID,
+    with_headers: bool = False,
+):
+    """
+    Consume 'topic' running up to 'max_in_flight' handler(message) calls (or
+    handler(message, headers), with 'with_headers') at the same time.
+    Messages are only acknowledged once every earlier message (of the same partition) has
+    been handled, so a crash never skips a message that was still being worked on.
+    Handler exceptions are logged and the message counts as handled: retrying (or not)
+    is the handler's business.
+    """
+
+    async def measured_handler(message: Payload, headers: dict[str, str]):
+        messages_in_flight.inc(topic=topic)
+        try:
+            with _consumed_span(topic, headers), message_handling_seconds.time(topic=topic):
+                await (handler(message, headers) if with_headers else handler(message))
+        finally:
+            messages_in_flight.dec(topic=topic)
+
+    component = consumer_component(topic, group_id)
+    health.expect(component)
     try:
-        async for message in consumer:
-            value = message.value.decode("utf-8")
-            log.info("Consumed message from Kafka", topic=topic, value=value)
-            if only_once:
-                await consumer.commit()
-            yield value
-    except Exception:
-        log.exception("Error consuming message from Kafka", topic=topic, value=value)
-        raise
+        await get_transport().consume_concurrently(
+            topic, measured_handler, group_id=group_id, max_in_flight=max_in_flight
+        )
     finally:
-        await consumer.stop()
+        health.set_ready(component, False)
+
+
+def _consumed_span(topic: str, headers: dict[str, str]) -> tracing.Span:
+    """The span of handling a message, child of the one that produced it."""
+    parent, enqueued_at = tracing.extract(headers)
+    queue_wait = None
+    if enqueued_at is not None:
+        queue_wait = max(time.time() - enqueued_at, 0)
+        message_queue_seconds.observe(queue_wait, topic=topic)
+    return tracing.span(topic, parent=parent, queue_wait_s=queue_wait)
+
+
+def _record_lag(consumer: AIOKafkaConsumer, message, group_id: str):
+    """How far behind the end of its partition 'message' is (as of the last fetch)."""
+    highwater = consumer.highwater(TopicPartition(message.topic, message.partition))
+    if highwater is not None:
+        consumer_lag.set(
+            highwater - message.offset - 1,
+            topic=message.topic,
+            partition=message.partition,
+            group=group_id,
+        )
+
+
+class _OffsetTracker(ConsumerRebalanceListener):
+    """
+    Keeps track of the in-flight offsets of each partition, so we can figure out up to which
+    offset we can commit: the one right after the last message of an unbroken run of
+    finished messages. Messages finishing out of order don't move the commit point forward
+    until all the earlier ones (on the same partition) are done too.
+    """
+
+    def __init__(self, group_id: str):
+        self.group_id = group_id
+        # Offsets arrive in order per partition, so (insertion ordered) dicts keep them sorted
+        self.pending: dict[TopicPartition, dict[int, bool]] = {}
+        self.committed: dict[TopicPartition, int] = {}
+
+    def start(self, tp: TopicPartition, offset: int):
+        self.pending.setdefault(tp, {})[offset] = False
+
+    def finish(self, tp: TopicPartition, offset: int):
+        offsets = self.pending.get(tp)
+        if offsets is None or offset not in offsets:
+            return  # Partition was revoked while the message was being processed
+        offsets[offset] = True
+
+    def committable(self) -> dict[TopicPartition, int]:
+        """Pop the finished heads of each partition and return what can be committed."""
+        to_commit = {}
+        for tp, offsets in self.pending.items():
+            last_done = None
+            for offset, done in offsets.items():
+                if not done:
+                    break
+                last_done = offset
+            if last_done is None:
+                continue
+            for offset in [o for o in offsets if o <= last_done]:
+                del offsets[offset]
+            if last_done + 1 > self.committed.get(tp, -1):
+                to_commit[tp] = last_done + 1
+        return to_commit
+
+    async def on_partitions_revoked(self, revoked):
+        # Whatever is still in flight for those partitions will be redelivered to whomever
+        # gets them now (at least once), so forget about it.
+        for tp in revoked:
+            self.pending.pop(tp, None)
+            self.committed.pop(tp, None)
+            consumer_lag.remove(topic=tp.topic, partition=tp.partition, group=self.group_id)
+
+    async def on_partitions_assigned(self, assigned):
+        pass
+
+
+def _headers(message) -> dict[str, str]:
+    return {key: value.decode("utf-8") for key, value in message.headers or ()}
+
+
+class KafkaTransport(Transport):
+    name = "kafka"
+
+    def __init__(self):
+        self._producer: AIOKafkaProducer | None = None
+        self._producer_lock = asyncio.Lock()
+
+    @staticmethod
+    def _producer_settings() -> dict:
+        """
+        Batching knobs for the shared producer. A few ms of linger lets aiokafka pack many
+        messages in the same request instead of doing one round trip per message.
+        """
+        return {
+            "linger_ms": int(os.getenv("KAFKA_LINGER_MS", default="5")),
+            "max_batch_size": int(os.getenv("KAFKA_MAX_BATCH_SIZE", default=str(64 * 1024))),
+            # None, "gzip", "snappy", "lz4" or "zstd" (the last three need their own libraries)
+            "compression_type": os.getenv("KAFKA_COMPRESSION") or None,
+        }
+
+    async def start(self) -> AIOKafkaProducer:
+        """Start the process-wide producer (if it wasn't started already)."""
+        async with self._producer_lock:
+            if self._producer is None:
+                settings = self._producer_settings()
+                producer = AIOKafkaProducer(bootstrap_servers=get_kafka_broker(), **settings)
+                await producer.start()
+                self._producer = producer
+                log.info("Started shared Kafka producer", **settings)
+        return self._producer
+
+    async def stop(self):
+        async with self._producer_lock:
+            if self._producer is None:
+                return
+            producer, self._producer = self._producer, None
+            try:
+                await producer.flush()
+            finally:
+                await producer.stop()
+            log.info("Stopped shared Kafka producer")
+
+    async def produce(self, topic, message, wait=True, headers=None) -> asyncio.Future:
+        producer = self._producer or await self.start()
+        try:
+            future = await producer.send(
+                topic,
+                message if isinstance(message, bytes) else message.encode("utf-8"),
+                headers=[(key, value.encode("utf-8")) for key, value in (headers or {}).items()],
+            )
+        except Exception:
+            log.exception("Error producing Kafka message", topic=topic, message=message)
+            raise
+
+        if not wait:
+            future.add_done_callback(log_send_result(topic, message))
+            return future
+
+        try:
+            await future
+            log.info(f"Produced Kafka message", topic=topic, message=message)
+        except Exception:
+            log.exception("Error producing Kafka message", topic=topic, message=message)
+            raise
+        return future
+
+    async def consume(self, topic, *, group_id=DEFAULT_GROUP_ID, only_once=True, ephemeral=False):
+        only_once = only_once and not ephemeral
+        consumer = AIOKafkaConsumer(
+            topic,
+            bootstrap_servers=get_kafka_broker(),
+            group_id=group_id,
+            # Committed below, and only with only_once. An ephemeral group has none: it starts
+            # from the latest message (auto_offset_reset) and the broker drops it once empty
+            enable_auto_commit=False,
+        )
+        await consumer.start()
+        health.set_ready(consumer_component(topic, group_id))
+        log.info("Starting consumer", topic=topic, group_id=group_id)
+        value = None
+        try:
+            async for message in consumer:
+                _record_lag(consumer, message, group_id)
+                value = message.value  # Bytes: see tools.envelope
+                log.info("Consumed message from Kafka", topic=topic, value=value)
+                yield value, _headers(message)
+                if only_once:
+                    await consumer.commit(
+                        {TopicPartition(message.topic, message.partition): message.offset + 1}
+                    )
+        except Exception:
+            log.exception("Error consuming message from Kafka", topic=topic, value=value)
+            raise
+        finally:
+            await consumer.stop()
+
+    async def consume_concurrently(
+        self, topic, handler, *, group_id=DEFAULT_GROUP_ID, max_in_flight=1
+    ):
+        """
+        Partition offsets are committed only once every earlier message on that partition
+        has been handled. When the window is full, fetching is paused until a slot frees up.
+        """
+        tracker = _OffsetTracker(group_id)
+        consumer = AIOKafkaConsumer(
+            bootstrap_servers=get_kafka_broker(),
+            group_id=group_id,
+            enable_auto_commit=False,
+        )
+        consumer.subscribe([topic], listener=tracker)
+        await consumer.start()
+        health.set_ready(consumer_component(topic, group_id))
+        log.info("Starting consumer", topic=topic, group_id=group_id, max_in_flight=max_in_flight)
+        commit_lock = asyncio.Lock()
+        in_flight: set[asyncio.Task] = set()
+
+        async def commit():
+            async with commit_lock:
+                offsets = tracker.committable()
+                if not offsets:
+                    return
+                try:
+                    await consumer.commit(offsets)
+                    tracker.committed.update(offsets)
+                except Exception:
+                    log.warning("Couldn't commit Kafka offsets", topic=topic, exc_info=True)
+
+        async def handle(message):
+            tp = TopicPartition(message.topic, message.partition)
+            value = message.value
+            try:
+                log.info("Consumed message from Kafka", topic=topic, value=value)
+                await handler(value, _headers(message))
+            except Exception:
+                log.exception("Error handling Kafka message", topic=topic, value=value)
+            finally:
+                tracker.finish(tp, message.offset)
+            await commit()
+
+        try:
+            while True:
+                if len(in_flight) >= max_in_flight:
+                    consumer.pause(*consumer.assignment())
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    consumer.resume(*consumer.paused())
+                    continue
+                message = await consumer.getone()
+                _record_lag(consumer, message, group_id)
+                tracker.start(TopicPartition(message.topic, message.partition), message.offset)
+                task = asyncio.create_task(handle(message))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Error consuming message from Kafka", topic=topic)
+            raise
+        finally:
+            # Drain: let whatever started finish (and get committed) before leaving the group
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+            await consumer.stop()
@@ -0,0 +1,105 @@
+"""
+In-process message transport (MESSAGE_TRANSPORT=memory): one asyncio.Queue per topic and
+consumer group. Messages are handed over as they are (no encoding, no copies, no network),
+so it only works when producers and consumers live in the same process. For instance: a
+single-box deployment running the backend and job_runner's stages together.
+"""
+
+import asyncio
+import os
+from collections import defaultdict, deque
+
+import structlog
+
+from tools import health
+from tools.transport import DEFAULT_GROUP_ID, Transport, consumer_component
+
+log = structlog.get_logger()
+
+
+class MemoryTransport(Transport):
+    name = "memory"
+
+    def __init__(self):
+        self._groups: dict[str, dict[str, asyncio.Queue]] = defaultdict(dict)  # Topic to groups
+        # Queues hold (message, headers) tuples.
+        # Messages produced before anybody subscribed to the topic. Like Kafka would, we keep
+        # them (up to a point) for the first group that shows up.
+        self._backlog: dict[str, deque] = defaultdict(
+            lambda: deque(maxlen=int(os.getenv("MEMORY_TRANSPORT_BACKLOG", default="100000")))
+        )
+
+    def _queue(self, topic: str, group_id: str, *, backlog: bool = True) -> asyncio.Queue:
+        groups = self._groups[topic]
+        if group_id not in groups:
+            queue = asyncio.Queue()
+            for message in self._backlog.pop(topic, ()) if backlog else ():
+                queue.put_nowait(message)
+            groups[group_id] = queue
+        return groups[group_id]
+
+    async def produce(self, topic, message, wait=True, headers=None) -> asyncio.Future:
+        entry = (message, dict(headers or {}))
+        groups = self._groups.get(topic)
+        if groups:
+            for queue in groups.values():
+                queue.put_nowait(entry)
+        else:
+            self._backlog[topic].append(entry)
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    async def consume(self, topic, *, group_id=DEFAULT_GROUP_ID, only_once=True, ephemeral=False):
+        only_once = only_once and not ephemeral
+        queue = self._queue(topic, group_id, backlog=not ephemeral)
+        health.set_ready(consumer_component(topic, group_id))
+        log.info("Starting consumer", topic=topic, group_id=group_id, transport=self.name)
+        try:
+            while True:
+                entry = await queue.get()
+                handled = False
+                try:
+                    yield entry
+                    handled = True
+                finally:
+                    if only_once and not handled:
+                        queue.put_nowait(entry)  # Whomever consumes next gets it (at least once)
+        finally:
+            if ephemeral:
+                self._groups[topic].pop(group_id, None)
+
+    async def consume_concurrently(
+        self, topic, handler, *, group_id=DEFAULT_GROUP_ID, max_in_flight=1
+    ):
+        queue = self._queue(topic, group_id)
+        health.set_ready(consumer_component(topic, group_id))
+        log.info(
+            "Starting consumer",
+            topic=topic,
+            group_id=group_id,
+            max_in_flight=max_in_flight,
+            transport=self.name,
+        )
+        slots = asyncio.Semaphore(max_in_flight)
+        in_flight: set[asyncio.Task] = set()
+
+        async def handle(message, headers: dict[str, str]):
+            try:
+                await handler(message, headers)
+            except Exception:
+                log.exception("Error handling message", topic=topic, value=message)
+            finally:
+                slots.release()
+
+        try:
+            while True:
+                await slots.acquire()
+                message, headers = await queue.get()
+                task = asyncio.create_task(handle(message, headers))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+        finally:
+            # Drain: whatever was taken from the queue gets handled
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
@@ -0,0 +1,237 @@
+"""
+In-process metrics: counters, gauges and fixed-bucket histograms, rendered in Prometheus'
+text format by render() (served at /metrics by the backend and by job_runner, see
+serve_metrics). Updating one is a dict lookup and an addition, so they're cheap enough for
+the hot paths. Metrics are per process: with several worker processes, scrape them all.
+
+    requests = metrics.counter("things_total", "Things done", ["kind"])
+    requests.inc(kind="foo")
+"""
+
+import asyncio
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Callable
+
+import structlog
+
+log = structlog.get_logger()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds. From "a Redis round trip" to "a whole (simulated) stage"
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # Updates come from the event loop, but also from threads (the sync DB engine)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _series(self, key: tuple, suffix: str = "", **extra) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra.items())
+        if not pairs:
+            return self.name + suffix
+        rendered = ",".join(f'{label}="{_escape(value)}"' for label, value in pairs)
+        return f"{self.name}{suffix}{{{rendered}}}"
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        return [f"{self._series(key)} {value}" for key, value in list(self._values.items())]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels=()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def remove(self, **labels):
+        self._values.pop(self._key(labels), None)
+
+    def set_function(self, function: Callable[[], float]):
+        """Compute the (unlabeled) value when scraped, instead of keeping it up to date."""
+        self._function = function
+
+    def value(self, **labels) -> float:
+        if self._function is not None:
+            return self._function()
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        if self._function is not None:
+            try:
+                return [f"{self.name} {self._function()}"]
+            except Exception:
+                log.warning("Couldn't compute gauge", metric=self.name, exc_info=True)
+                return []
+        return [f"{self._series(key)} {value}" for key, value in list(self._values.items())]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Labels to ([count per bucket, plus the +Inf one], sum, count)
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the 'with' block takes."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total, count) in list(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self._series(key, '_bucket', le=bound)} {cumulative}")
+            lines.append(f"{self._series(key, '_sum')} {total}")
+            lines.append(f"{self._series(key, '_count')} {count}")
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_registry: dict[str, _Metric] = {}
+
+
+def _get_or_create(cls, name: str, help: str, labels, **kwargs):
+    metric = _registry.get(name)
+    if metric is None:
+        metric = _registry[name] = cls(name, help, labels, **kwargs)
+    elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+        raise ValueError(f"Metric {name} already exists, with another type or labels")
+    return metric
+
+
+def counter(name: str, help: str, labels=()) -> Counter:
+    return _get_or_create(Counter, name, help, labels)
+
+
+def gauge(name: str, help: str, labels=()) -> Gauge:
+    return _get_or_create(Gauge, name, help, labels)
+
+
+def histogram(name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+
+def render() -> str:
+    """Every metric of this process, in Prometheus' text format."""
+    return "\n".join(metric.render() for metric in list(_registry.values())) + "\n"
+
+
+async def serve_metrics(
+    port: int, routes: dict[str, Callable[[], Awaitable[tuple[str, str, bytes]]]] | None = None
+):
+    """
+    A tiny HTTP server answering GET /metrics (for processes without a web app, like
+    job_runner). Runs until cancelled.
+    'routes' are more paths to answer: path to a coroutine function returning the
+    (status line, content type, body). Like tools.health's http_routes.
+    """
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b""):
+                pass  # Headers. We don't care.
+            parts = request_line.decode("latin-1").split()
+            path = parts[1].split("?")[0] if len(parts) >= 2 and parts[0] == "GET" else None
+            if path == "/metrics":
+                status, content_type, body = "200 OK", CONTENT_TYPE, render().encode()
+            elif path in (routes or {}):
+                status, content_type, body = await routes[path]()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception:
+            log.debug("Error serving metrics", exc_info=True)
+        finally:
+            writer.close()
+
+    try:
+        server = await asyncio.start_server(handle, host="0.0.0.0", port=port)
+    except OSError:
+        log.warning("Couldn't serve metrics", port=port, exc_info=True)
+        return
+    log.info("Serving metrics", port=port)
+    async with server:
+        await server.serve_forever()
@@ -12,6 +12,6 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verifies a password against a stored bcrypt hash."""
     if not plain_password:
         return False
-    if not hash_password:
+    if not hashed_password:
         return False
     return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
@@ -0,0 +1,175 @@
+"""
+Redis Streams message transport (MESSAGE_TRANSPORT=redis). Each topic is a stream and each
+consumer group a Redis consumer group on it. Messages are XACK'ed once handled; the ones a
+dead consumer left unacknowledged for REDIS_STREAMS_CLAIM_IDLE_MS are claimed (and
+redelivered) by the surviving consumers of the group.
+Entries have a "data" field (the message, or "bin" with it in base64 if it's bytes: our
+client decodes responses as UTF-8) and, if there are headers, a "headers" one (JSON).
+"""
+
+import asyncio
+import base64
+import itertools
+import json
+import os
+import socket
+import time
+
+import structlog
+from redis.exceptions import ResponseError
+
+from tools import health, util_redis
+from tools.transport import DEFAULT_GROUP_ID, Transport, consumer_component, log_send_result
+
+log = structlog.get_logger()
+
+_consumer_ids = itertools.count()
+
+
+def _message(fields: dict):
+    if "bin" in fields:
+        return base64.b64decode(fields["bin"])
+    return fields["data"]
+
+
+class RedisStreamsTransport(Transport):
+    name = "redis"
+
+    def __init__(self):
+        self.maxlen = int(os.getenv("REDIS_STREAMS_MAXLEN", default="1000000"))
+        self.claim_idle_ms = int(os.getenv("REDIS_STREAMS_CLAIM_IDLE_MS", default="60000"))
+        self.block_ms = int(os.getenv("REDIS_STREAMS_BLOCK_MS", default="1000"))
+        self._ready_groups: set[tuple[str, str]] = set()
+
+    async def produce(self, topic, message, wait=True, headers=None) -> asyncio.Future:
+        if isinstance(message, bytes):
+            fields = {"bin": base64.b64encode(message).decode("ascii")}
+        else:
+            fields = {"data": message}
+        if headers:
+            fields["headers"] = json.dumps(headers)
+        delivery = asyncio.ensure_future(
+            util_redis.get_async_client().xadd(topic, fields, maxlen=self.maxlen, approximate=True)
+        )
+        if not wait:
+            delivery.add_done_callback(log_send_result(topic, message))
+            return delivery
+        try:
+            await delivery
+            log.info("Produced Redis Streams message", topic=topic, message=message)
+        except Exception:
+            log.exception("Error producing Redis Streams message", topic=topic, message=message)
+            raise
+        return delivery
+
+    async def _ensure_group(self, topic: str, group_id: str, *, ephemeral: bool = False):
+        if (topic, group_id) in self._ready_groups:
+            return
+        try:
+            # From the beginning of the stream: what was produced before the group existed
+            # must be processed too. Unless it's an ephemeral group: from now on
+            await util_redis.get_async_client().xgroup_create(
+                topic, group_id, id="$" if ephemeral else "0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):  # Group already exists. That's fine.
+                raise
+        self._ready_groups.add((topic, group_id))
+
+    def _reader(self, topic: str, group_id: str, *, noack: bool = False):
+        """
+        Returns read(count) -> [(entry_id, message, headers), ...] for a new consumer of the
+        group.
+        """
+        client = util_redis.get_async_client()
+        consumer = f"{socket.gethostname()}-{os.getpid()}-{next(_consumer_ids)}"
+        next_claim = 0.0
+
+        async def read(count: int) -> list[tuple[str, str, dict[str, str]]]:
+            nonlocal next_claim
+            entries = []
+            if not noack and time.monotonic() >= next_claim:
+                # Messages some (probably dead) consumer of the group never acknowledged
+                next_claim = time.monotonic() + self.claim_idle_ms / 2000
+                _, entries, *_ = await client.xautoclaim(
+                    topic, group_id, consumer, self.claim_idle_ms, start_id="0-0", count=count
+                )
+            if not entries:
+                response = await client.xreadgroup(
+                    group_id, consumer, {topic: ">"}, count=count, block=self.block_ms, noack=noack
+                )
+                entries = response[0][1] if response else []
+            return [
+                (entry_id, _message(fields), json.loads(fields.get("headers") or "{}"))
+                for entry_id, fields in entries
+                if fields
+            ]
+
+        return read
+
+    async def consume(self, topic, *, group_id=DEFAULT_GROUP_ID, only_once=True, ephemeral=False):
+        only_once = only_once and not ephemeral
+        await self._ensure_group(topic, group_id, ephemeral=ephemeral)
+        health.set_ready(consumer_component(topic, group_id))
+        client = util_redis.get_async_client()
+        read = self._reader(topic, group_id, noack=not only_once)
+        log.info("Starting consumer", topic=topic, group_id=group_id, transport=self.name)
+        try:
+            while True:
+                for entry_id, message, headers in await read(1):
+                    yield message, headers
+                    if only_once:
+                        await client.xack(topic, group_id, entry_id)
+        finally:
+            if ephemeral:
+                await self._destroy_group(topic, group_id)
+
+    async def _destroy_group(self, topic: str, group_id: str):
+        self._ready_groups.discard((topic, group_id))
+        try:
+            await util_redis.get_async_client().xgroup_destroy(topic, group_id)
+        except Exception as e:
+            log.warning(
+                "Couldn't remove consumer group", topic=topic, group_id=group_id, error=repr(e)
+            )
+
+    async def consume_concurrently(
+        self, topic, handler, *, group_id=DEFAULT_GROUP_ID, max_in_flight=1
+    ):
+        """Every entry is acknowledged on its own, so there's no ordering to wait for."""
+        await self._ensure_group(topic, group_id)
+        health.set_ready(consumer_component(topic, group_id))
+        client = util_redis.get_async_client()
+        read = self._reader(topic, group_id)
+        log.info(
+            "Starting consumer",
+            topic=topic,
+            group_id=group_id,
+            max_in_flight=max_in_flight,
+            transport=self.name,
+        )
+        in_flight: set[asyncio.Task] = set()
+
+        async def handle(entry_id: str, message, headers: dict[str, str]):
+            try:
+                await handler(message, headers)
+            except Exception:
+                log.exception("Error handling message", topic=topic, value=message)
+            try:
+                await client.xack(topic, group_id, entry_id)
+            except Exception:
+                log.warning("Couldn't acknowledge message", topic=topic, exc_info=True)
+
+        try:
+            while True:
+                if len(in_flight) >= max_in_flight:
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                for entry_id, message, headers in await read(max_in_flight - len(in_flight)):
+                    task = asyncio.create_task(handle(entry_id, message, headers))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+        finally:
+            # Drain: let whatever started finish (and get acknowledged)
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
@@ -0,0 +1,241 @@
+"""
+Tracing across the hops of a sync task: the HTTP request, the jobA/jobB/jobC stages, the
+status updates... Each hop is a span, and spans are linked through message headers (see
+tools.kafka's produce_message and consumers):
+- traceparent: W3C style "00-<trace id>-<parent span id>-01"
+- baggage: "key=value,..." pairs every span of the trace inherits (like task_id)
+- enqueued_at: epoch seconds when the message was produced, so consumers can tell how long
+  it waited in the queue
+
+Finished spans are written (as JSON lines) to TRACE_FILE, if set, by a background thread.
+Then, to see where the time of a task went:
+    python -m tools.tracing <task_id> [--file spans.jsonl]
+or, without a task_id, a summary of every kind of span.
+"""
+
+import argparse
+import atexit
+import json
+import os
+import queue
+import secrets
+import statistics
+import threading
+import time
+from contextvars import ContextVar
+
+import structlog
+
+log = structlog.get_logger()
+
+TRACE_FILE = os.getenv("TRACE_FILE")  # Unset: spans still link hops, but aren't written
+
+
+class SpanContext:
+    def __init__(self, trace_id: str, span_id: str, baggage: dict[str, str] | None = None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.baggage = baggage or {}
+
+
+_current: ContextVar[SpanContext | None] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    A timed hop. As a context manager, it's also the current span (the parent of the spans
+    started, and the messages produced, inside it). Otherwise, call end() when it's done.
+    """
+
+    def __init__(self, name: str, parent: SpanContext | None, baggage: dict, attributes: dict):
+        self.name = name
+        self.parent_id = parent.span_id if parent else None
+        self.context = SpanContext(
+            parent.trace_id if parent else secrets.token_hex(16),
+            secrets.token_hex(8),
+            {**(parent.baggage if parent else {}), **{k: str(v) for k, v in baggage.items()}},
+        )
+        self.attributes = attributes
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self._token = None
+        self._ended = False
+
+    def set_baggage(self, **baggage):
+        """Add baggage (it goes to this span, its children and the messages produced in it)."""
+        self.context.baggage.update({key: str(value) for key, value in baggage.items()})
+
+    def end(self):
+        if self._ended:
+            return
+        self._ended = True
+        if _exporter is not None:
+            _exporter.export(
+                {
+                    "name": self.name,
+                    "trace_id": self.context.trace_id,
+                    "span_id": self.context.span_id,
+                    "parent_id": self.parent_id,
+                    "start": self.start,
+                    "duration_s": time.perf_counter() - self._started,
+                    **self.context.baggage,
+                    **self.attributes,
+                }
+            )
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self.context)
+        return self
+
+    def __exit__(self, exc_type, exc, _traceback):
+        _current.reset(self._token)
+        if exc is not None:
+            self.attributes["error"] = repr(exc)
+        self.end()
+
+
+def span(
+    name: str, *, parent: SpanContext | None = None, baggage: dict | None = None, **attributes
+):
+    """A new span, child of 'parent' (by default, the current span, if any)."""
+    return Span(name, parent or _current.get(), baggage or {}, attributes)
+
+
+def inject() -> dict[str, str]:
+    """Headers for a message produced now, from within the current span (if any)."""
+    headers = {"enqueued_at": repr(time.time())}
+    context = _current.get()
+    if context is not None:
+        headers["traceparent"] = f"00-{context.trace_id}-{context.span_id}-01"
+        if context.baggage:
+            headers["baggage"] = ",".join(f"{k}={v}" for k, v in context.baggage.items())
+    return headers
+
+
+def extract(headers: dict[str, str]) -> tuple[SpanContext | None, float | None]:
+    """The (parent span context, enqueued_at) out of a message's headers (see inject)."""
+    context = enqueued_at = None
+    try:
+        if "traceparent" in headers:
+            _version, trace_id, span_id, _flags = headers["traceparent"].split("-")
+            baggage = dict(
+                pair.split("=", 1) for pair in headers.get("baggage", "").split(",") if "=" in pair
+            )
+            context = SpanContext(trace_id, span_id, baggage)
+        if "enqueued_at" in headers:
+            enqueued_at = float(headers["enqueued_at"])
+    except ValueError:
+        log.warning("Invalid trace headers", headers=headers)
+    return context, enqueued_at
+
+
+class _FileExporter:
+    """Appends spans to a JSON lines file from a background thread (no I/O on the loop)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, record: dict):
+        self._queue.put(record)
+
+    def flush(self, timeout: float = 5):
+        """Wait until everything exported so far is written."""
+        written = threading.Event()
+        self._queue.put(written)
+        written.wait(timeout)
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as file:
+            while True:
+                items = [self._queue.get()]
+                while not self._queue.empty():
+                    items.append(self._queue.get())
+                lines = [json.dumps(item) + "\n" for item in items if isinstance(item, dict)]
+                if lines:
+                    file.write("".join(lines))  # Whole lines: processes can share the file
+                    file.flush()
+                for item in items:
+                    if isinstance(item, threading.Event):
+                        item.set()
+
+
+_exporter = _FileExporter(TRACE_FILE) if TRACE_FILE else None
+if _exporter is not None:
+    atexit.register(_exporter.flush)
+
+
+def flush():
+    if _exporter is not None:
+        _exporter.flush()
+
+
+def read_spans(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def timeline(spans: list[dict], task_id) -> list[dict]:
+    """The spans of the task, in order, with 'offset_s' since the first one started."""
+    spans = sorted((s for s in spans if s.get("task_id") == str(task_id)), key=lambda s: s["start"])
+    if not spans:
+        return []
+    first = min(s["start"] - (s.get("queue_wait_s") or 0) for s in spans)
+    return [{**s, "offset_s": s["start"] - first} for s in spans]
+
+
+def summarize(spans: list[dict]) -> dict[str, dict]:
+    """Per span name: how many, and the p50/p95 of their duration and queue wait (in ms)."""
+
+    def percentiles(values: list[float]) -> dict:
+        if not values:
+            return {}
+        values = sorted(values)
+        return {
+            f"p{int(p * 100)}_ms": round(
+                values[min(int(p * len(values)), len(values) - 1)] * 1000, 3
+            )
+            for p in (0.5, 0.95)
+        }
+
+    by_name: dict[str, list[dict]] = {}
+    for s in spans:
+        by_name.setdefault(s["name"], []).append(s)
+    return {
+        name: {
+            "count": len(group),
+            "mean_ms": round(statistics.fmean(s["duration_s"] for s in group) * 1000, 3),
+            "duration": percentiles([s["duration_s"] for s in group]),
+            "queue_wait": percentiles(
+                [s["queue_wait_s"] for s in group if s.get("queue_wait_s") is not None]
+            ),
+        }
+        for name, group in by_name.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Where did the time of a sync task go?")
+    parser.add_argument("task_id", nargs="?", help="Without it: a summary of every hop")
+    parser.add_argument("--file", default=TRACE_FILE, help="Spans file (default: $TRACE_FILE)")
+    args = parser.parse_args()
+    if not args.file:
+        parser.error("No spans file: use --file or set TRACE_FILE")
+
+    spans = read_spans(args.file)
+    if args.task_id is None:
+        print(json.dumps(summarize(spans), indent=2))
+        return
+    for s in timeline(spans, args.task_id):
+        queue_wait = s.get("queue_wait_s")
+        print(
+            f"{s['offset_s'] * 1000:10.1f} ms  {s['name']:<20}"
+            f" waited {queue_wait * 1000 if queue_wait is not None else 0:8.1f} ms"
+            f"  took {s['duration_s'] * 1000:8.1f} ms" + (f"  {s['error']}" if "error" in s else "")
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+What a message transport must provide to sit behind tools.kafka's functions
+(produce_message, consume_messages, consume_concurrently...). Which one is used is
+decided by the MESSAGE_TRANSPORT environment variable (see tools.kafka.get_transport):
+- "kafka" (default): tools.kafka.KafkaTransport
+- "memory": tools.memory_transport.MemoryTransport. Only when everything (backend and
+  job_runner stages) runs in the same process.
+- "redis": tools.redis_streams.RedisStreamsTransport
+
+All of them deliver messages at least once, and within a consumer group each message
+goes to one consumer only (while each group gets all the messages).
+Messages are bytes or str (see tools.envelope for what goes in them). Consumers might get
+a str message as bytes (UTF-8), depending on the transport. Messages can carry headers (a
+str to str dict: trace context, enqueue time... see tools.tracing), which consumers get
+along with the message. Consumers report to tools.health once they're in their group (see
+consumer_component).
+"""
+
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable
+
+import structlog
+
+log = structlog.get_logger()
+
+DEFAULT_GROUP_ID = "sync_group"
+
+Payload = str | bytes
+Handler = Callable[[Payload], Awaitable[None]]
+HeadersHandler = Callable[[Payload, dict[str, str]], Awaitable[None]]  # (message, headers)
+
+
+class Transport:
+    name = "abstract"
+
+    async def start(self):
+        """Get ready to produce (connect, start the producer...)."""
+
+    async def stop(self):
+        """Flush whatever is pending and release the resources."""
+
+    async def produce(
+        self,
+        topic: str,
+        message: Payload,
+        wait: bool = True,
+        headers: dict[str, str] | None = None,
+    ) -> asyncio.Future:
+        """
+        Send 'message' (with 'headers') to 'topic'. With wait=True, return once it's been
+        delivered to the transport. With wait=False, return as soon as it's queued, with a
+        future that resolves when it's delivered.
+        """
+        raise NotImplementedError()
+
+    def consume(
+        self,
+        topic: str,
+        *,
+        group_id: str = DEFAULT_GROUP_ID,
+        only_once: bool = True,
+        ephemeral: bool = False,
+    ) -> AsyncIterator[tuple[Payload, dict[str, str]]]:
+        """
+        Yield the (message, headers) of 'topic' one by one. With only_once, a message is
+        acknowledged once the caller is done with it (when it asks for the next one). Without
+        it, none is.
+        An 'ephemeral' group is this consumer's alone (like one per process) and lives as long
+        as it does: it starts from the latest message, acknowledges none, and the transport
+        forgets about it once the consumer stops.
+        """
+        raise NotImplementedError()
+
+    async def consume_concurrently(
+        self,
+        topic: str,
+        handler: HeadersHandler,
+        *,
+        group_id: str = DEFAULT_GROUP_ID,
+        max_in_flight: int = 1,
+    ):
+        """
+        Run handler(message, headers) for every message of 'topic', up to 'max_in_flight' at
+        a time.
+        A message is acknowledged once its handler finishes (even if it raised: retrying is
+        the handler's business), and never before the earlier messages it must come after.
+        """
+        raise NotImplementedError()
+
+
+def consumer_component(topic: str, group_id: str) -> str:
+    """
+    The name a consumer goes by in tools.health. Transports mark it as ready once the
+    consumer joined its group (tools.kafka's consume functions expect it, and clear it).
+    """
+    return f"consumer:{topic}:{group_id}"
+
+
+def log_send_result(topic: str, message: Payload):
+    """Done-callback for fire-and-forget deliveries: nobody awaits them, so log failures."""
+
+    def callback(future: asyncio.Future):
+        if future.cancelled():
+            log.warning("Message send cancelled", topic=topic, message=message)
+        elif future.exception() is not None:
+            log.error(
+                "Error producing message",
+                topic=topic,
+                message=message,
+                exc_info=future.exception(),
+            )
+
+    return callback
@@ -1,17 +1,149 @@
+import asyncio
+import json
 import os
+from typing import Awaitable, Callable
 
 import redis
+import redis.asyncio as aioredis
+import structlog
+
+from tools import metrics
+
+log = structlog.get_logger()
+
+# How long a known status stays cached, and how long we remember that a task doesn't exist.
+# The negative entry is short-lived: a task created right after the miss must show up soon.
+STATUS_TTL = int(os.getenv("REDIS_STATUS_TTL", default=str(60 * 60 * 5)))
+NOT_FOUND_TTL = int(os.getenv("REDIS_NOT_FOUND_TTL", default="30"))
 
 _redis_client = None
+_async_redis_client = None
+_inflight_loads: dict[str, asyncio.Future] = {}  # Cache key to the DB load in progress
+
+# 'cache' is the key's prefix (like "task-status"). 'result' is hit, miss or shared (a miss
+# that waited for somebody else's load)
+cache_lookups = metrics.counter("cache_lookups_total", "read_through lookups", ["cache", "result"])
+cache_load_seconds = metrics.histogram(
+    "cache_load_seconds", "read_through loads (on misses)", ["cache"]
+)
+
+
+def _redis_url() -> str:
+    return os.getenv("REDIS_URL", default="redis://redis:6379")
 
 
 def get_client():
     global _redis_client
     if _redis_client is None:
-        redis_url = os.getenv("REDIS_URL", default="redis://redis:6379")
-        _redis_client = redis.StrictRedis.from_url(redis_url, decode_responses=True)
+        _redis_client = redis.StrictRedis.from_url(_redis_url(), decode_responses=True)
     return _redis_client
 
 
+def get_async_client() -> aioredis.Redis:
+    """Pooled asyncio Redis client. Use this one from coroutines, not get_client()."""
+    global _async_redis_client
+    if _async_redis_client is None:
+        pool = aioredis.ConnectionPool.from_url(
+            _redis_url(),
+            decode_responses=True,
+            max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", default="50")),
+        )
+        _async_redis_client = aioredis.Redis(connection_pool=pool)
+    return _async_redis_client
+
+
+async def close_async_client():
+    global _async_redis_client
+    if _async_redis_client is not None:
+        client, _async_redis_client = _async_redis_client, None
+        await client.aclose()
+
+
+async def ping():
+    """Raise if Redis doesn't answer."""
+    await get_async_client().ping()
+
+
 def task_status_key(task_id: int | str) -> str:
     return f"task-status_{task_id}"
+
+
+def task_status_channel(task_id: int | str) -> str:
+    """Pub/sub channel where the status changes of the task are published"""
+    return f"task-status-updates_{task_id}"
+
+
+def user_status_channel(user_id: str) -> str:
+    """Pub/sub channel where the status changes of all the tasks of the user are published"""
+    return f"user-status-updates_{user_id}"
+
+
+def encode_status(status: str, version: int) -> str:
+    """What's cached under task_status_key: the status and its version (see decode_status)"""
+    return json.dumps({"status": status, "version": version})
+
+
+def decode_status(value: str) -> tuple[str, int]:
+    """(status, version) out of what encode_status cached."""
+    if not value.startswith("{"):
+        return value, 0  # Cached before statuses had versions
+    data = json.loads(value)
+    return data["status"], data["version"]
+
+
+async def read_through(
+    key: str,
+    loader: Callable[[], Awaitable[str | None]],
+    *,
+    ttl: int = STATUS_TTL,
+    negative_value: str,
+    negative_ttl: int = NOT_FOUND_TTL,
+) -> str:
+    """
+    Read 'key' from Redis. On a miss, call 'loader' (typically a DB query) and store what it
+    returned with 'ttl' seconds of expiry. If the loader returns None, 'negative_value' is
+    cached instead, but only for 'negative_ttl' seconds.
+    Concurrent misses for the same key (in this process) share a single loader call.
+    """
+    cache = key.split("_", 1)[0]
+    client = get_async_client()
+    value = await client.get(key)
+    if value is not None:
+        cache_lookups.inc(cache=cache, result="hit")
+        return value
+
+    inflight = _inflight_loads.get(key)
+    if inflight is not None:
+        cache_lookups.inc(cache=cache, result="shared")
+    else:
+        log.info("Cache miss. Loading value.", key=key)
+        cache_lookups.inc(cache=cache, result="miss")
+        # Its own task: if the request that started it goes away (client disconnected...),
+        # the others waiting for the same value still get it
+        inflight = asyncio.ensure_future(
+            _load(key, loader, cache, ttl, negative_value, negative_ttl)
+        )
+        _inflight_loads[key] = inflight
+        inflight.add_done_callback(_load_done(key))
+    return await asyncio.shield(inflight)
+
+
+async def _load(key, loader, cache, ttl, negative_value, negative_ttl) -> str:
+    with cache_load_seconds.time(cache=cache):
+        value = await loader()
+    if value is None:
+        value, expiry = negative_value, negative_ttl
+    else:
+        expiry = ttl
+    await get_async_client().set(key, value, ex=expiry)
+    return value
+
+
+def _load_done(key: str):
+    def done(task: asyncio.Task):
+        if _inflight_loads.get(key) is task:
+            _inflight_loads.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # Mark it as retrieved: nobody might be waiting for it
+
+    return done
@@ -0,0 +1,237 @@
+"""
+Load and latency benchmark. Runs the FastAPI app (with uvicorn, on a local port) and the
+job_runner stages in this very process, against the stand-ins in stand_ins.py (SQLite and
+a fake Redis) and the in-process message transport, and drives load at:
+    /login, /sync/{meeting_id}/start, /sync/{task_id}/status, /sync and the status websocket
+It reports requests/s and p50/p95/p99 latencies of each of them, plus the end to end time
+of a task (from "scheduled" to "completed"/"failed", as seen through the websocket) and
+how it breaks down by hop (see tools.tracing).
+Results are saved as JSON, so runs can be compared across commits.
+
+Usage (from the repository root):
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/load_test.py --requests 1000 --concurrency 50 --tasks 200
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = REPO_ROOT / "benchmarks" / "results"
+
+
+def _percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def _summary(latencies: list[float], errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "requests_per_second": round((len(latencies) + errors) / elapsed, 2) if elapsed else 0,
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0,
+    }
+
+
+async def _drive(name: str, make_request, total: int, concurrency: int) -> dict:
+    """Run make_request(i) 'total' times, 'concurrency' at a time, and time each one."""
+    latencies: list[float] = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def client():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                await make_request(i)
+            except Exception:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    result = _summary(latencies, errors, time.perf_counter() - started)
+    print(f"{name:>10}: {result}")
+    return result
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+async def run(args) -> dict:
+    import httpx
+    import uvicorn
+    import websockets
+
+    import job_runner
+    from app.main import app
+    from app.migrate import migrate
+    from stand_ins import FakeRedis, install
+    from tools.database import engine
+
+    install(FakeRedis())
+    migrate()
+    engine.dispose()  # Connections opened before install() don't have the SQLite pragmas
+
+    server = uvicorn.Server(
+        uvicorn.Config(
+            app,
+            host="127.0.0.1",
+            port=args.port,
+            log_level="info" if args.verbose else "critical",
+            timeout_graceful_shutdown=1,
+        )
+    )
+    server_task = asyncio.create_task(server.serve())
+    worker_task = asyncio.create_task(job_runner.main())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    ws_url = f"ws://127.0.0.1:{args.port}"
+    results = {}
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as http:
+
+        async def login(_i):
+            response = await http.post("/login", data={"username": "hector", "password": "hector"})
+            response.raise_for_status()
+            return response.json()["access_token"]
+
+        results["login"] = await _drive("login", login, args.logins, args.concurrency)
+        headers = {"Authorization": f"Bearer {await login(0)}"}
+
+        # Start the tasks and follow each of them through its websocket
+        task_ids: list[int] = []
+        end_to_end: list[float] = []
+        followers: list[asyncio.Task] = []
+
+        async def follow(task_id: int, scheduled_at: float):
+            async with websockets.connect(f"{ws_url}/ws/sync/{task_id}/status") as ws:
+                while True:
+                    data = json.loads(await asyncio.wait_for(ws.recv(), args.task_timeout))
+                    if data.get("type") == "ping":
+                        await ws.send(json.dumps({"action": "pong"}))
+                    elif data["status"] in ("completed", "failed"):
+                        end_to_end.append(time.perf_counter() - scheduled_at)
+                        return
+
+        async def start(i):
+            scheduled_at = time.perf_counter()
+            response = await http.post(f"/sync/{i + 1}/start", headers=headers)
+            response.raise_for_status()
+            task_id = response.json()["task_id"]
+            task_ids.append(task_id)
+            followers.append(asyncio.create_task(follow(task_id, scheduled_at)))
+
+        results["start"] = await _drive("start", start, args.tasks, args.concurrency)
+
+        async def status(_i):
+            response = await http.get(f"/sync/{random.choice(task_ids)}/status", headers=headers)
+            response.raise_for_status()
+
+        results["status"] = await _drive("status", status, args.requests, args.concurrency)
+
+        async def list_syncs(_i):
+            response = await http.get("/sync", headers=headers)
+            response.raise_for_status()
+
+        results["list"] = await _drive("list", list_syncs, args.requests, args.concurrency)
+
+        done = await asyncio.gather(*followers, return_exceptions=True)
+        missed = sum(isinstance(outcome, BaseException) for outcome in done)
+        results["end_to_end"] = _summary(end_to_end, missed, 1)
+        results["end_to_end"].pop("requests_per_second")
+        print(f"{'end_to_end':>10}: {results['end_to_end']}")
+
+    server.should_exit = True
+    worker_task.cancel()
+    await asyncio.gather(server_task, worker_task, return_exceptions=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=1000, help="Per read-only endpoint")
+    parser.add_argument("--logins", type=int, default=50)
+    parser.add_argument("--tasks", type=int, default=100, help="Sync tasks to start")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--stage-seconds", type=float, default=0.05, help="Simulated work")
+    parser.add_argument("--task-timeout", type=float, default=60)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", type=Path, default=None, help="Where to save the JSON")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's info logs")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fthm_bench_")
+    # Must be set before anything imports tools.database
+    os.environ["DATABASE_URL"] = f"sqlite:///{workdir}/bench.db"
+    os.environ["MESSAGE_TRANSPORT"] = "memory"
+    os.environ["SIMULATED_WORK_SECONDS"] = str(args.stage_seconds)
+    os.environ.setdefault("RETRY_BACKOFF_SECONDS", str(args.stage_seconds))  # Stage failures
+    os.environ["WORKER_METRICS_PORT"] = "0"  # Same process: the app's /metrics has it all
+    os.environ["TRACE_FILE"] = f"{workdir}/spans.jsonl"
+    sys.path[:0] = [
+        str(REPO_ROOT / "benchmarks"),
+        str(REPO_ROOT / "backend"),
+        str(REPO_ROOT / "worker"),
+    ]
+    if not args.verbose:
+        # Stages fail on purpose every now and then: that's a lot of (expected) tracebacks
+        import logging
+
+        import structlog
+
+        structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.CRITICAL))
+
+    results = asyncio.run(run(args))
+
+    # Where the end to end time went: each hop's duration and time waiting in its queue
+    from tools import tracing
+
+    tracing.flush()
+    results["hops"] = tracing.summarize(tracing.read_spans(os.environ["TRACE_FILE"]))
+    for hop, summary in results["hops"].items():
+        print(f"{hop:>16}: {summary}")
+    commit = _git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+    output = args.output
+    if output is None:
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = RESULTS_DIR / f"{stamp}-{commit or 'nocommit'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, default=str))
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Local stand-ins for the infrastructure docker-compose gives us, so the backend and the
+worker can run in a single process without MySQL, Redis or Kafka:
+- SQLite (just point DATABASE_URL to a file before importing tools.database)
+- FakeRedis: the (tiny) part of redis.asyncio.Redis we use
+- Kafka: not here. Use the in-process transport (MESSAGE_TRANSPORT=memory)
+"""
+
+import time
+
+from sqlalchemy import event
+
+
+class FakeRedis:
+    """In-memory, asyncio flavored, Redis. Only what tools.util_redis and its users need."""
+
+    def __init__(self):
+        self._data: dict[str, tuple[str, float | None]] = {}
+
+    def _alive(self, key: str) -> str | None:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def ping(self) -> bool:
+        return True
+
+    async def get(self, key: str) -> str | None:
+        return self._alive(key)
+
+    async def exists(self, *keys: str) -> int:
+        return sum(self._alive(key) is not None for key in keys)
+
+    async def set(self, key: str, value, ex: int | None = None, **_kwargs) -> bool:
+        self._data[key] = (str(value), time.monotonic() + ex if ex else None)
+        return True
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self._data.pop(key, None) is not None for key in keys)
+
+    async def publish(self, channel: str, message: str) -> int:
+        return 0  # Nobody listens: the benchmark uses STATUS_FANOUT=kafka
+
+    def pipeline(self, transaction: bool = True) -> "FakePipeline":
+        return FakePipeline(self)
+
+    async def aclose(self):
+        pass
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self._redis = redis
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_exc_info):
+        self._commands.clear()
+
+    def __getattr__(self, name):
+        method = getattr(self._redis, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+
+        return queue
+
+    async def execute(self) -> list:
+        commands, self._commands = self._commands, []
+        return [await method(*args, **kwargs) for method, args, kwargs in commands]
+
+
+def install(redis: FakeRedis):
+    """Make util_redis return 'redis' and tune SQLite for concurrent access."""
+    from tools import util_redis
+    from tools.database import async_engine, engine, replicas
+
+    util_redis._async_redis_client = redis
+
+    # SQLite: let readers and the writer get along, and wait (instead of failing) when locked
+    replica_engines = [replica.engine.sync_engine for replica in replicas.replicas]
+    for sync_engine in (engine, async_engine.sync_engine, *replica_engines):
+        if sync_engine.dialect.name == "sqlite":
+            event.listen(sync_engine, "connect", _sqlite_pragmas)
+
+
+def _sqlite_pragmas(dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
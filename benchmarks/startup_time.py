@@ -0,0 +1,175 @@
+"""
+Cold start benchmark. Starts the backend (the FastAPI app, with uvicorn) and job_runner,
+each in a fresh Python process, several times, against the stand-ins in stand_ins.py and
+the in-process message transport, and reports (medians) how long each one takes to:
+- import: import its modules (app.main, job_runner)
+- live: answer /health/live
+- ready: answer /health/ready with a 200 (DB pool, Redis, producer and consumers warm)
+- process: start, get ready and exit, interpreter start included
+Live and ready are seconds since the process (well, this module) started. With --max-ready,
+it fails (exit status 1) when a median "ready" is slower than that, so it can guard against
+regressions.
+The schema is created once, up front (see app/migrate.py): it's not part of starting.
+
+Usage (from the repository root):
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/startup_time.py --runs 5 --max-ready 3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+_process_started = time.perf_counter()
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = REPO_ROOT / "benchmarks" / "results"
+SERVICES = ("backend", "worker")
+
+
+async def _wait_for(http, url: str, timeout: float) -> float:
+    """Poll 'url' until it answers a 200, and return when it did (since process start)."""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            if (await http.get(url)).status_code == 200:
+                return time.perf_counter() - _process_started
+        except Exception:
+            pass
+        await asyncio.sleep(0.005)
+    raise TimeoutError(f"{url} wasn't OK after {timeout}s")
+
+
+async def _child(service: str, port: int, timeout: float) -> dict:
+    """Start 'service' in this (fresh) process and time it. See the module's docstring."""
+    started = time.perf_counter()
+    if service == "backend":
+        import uvicorn
+
+        from app.main import app
+    else:
+        import job_runner
+    imported = time.perf_counter() - started
+
+    import httpx
+
+    from stand_ins import FakeRedis, install
+
+    install(FakeRedis())
+    if service == "backend":
+        config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="critical")
+        task = asyncio.create_task(uvicorn.Server(config).serve())
+    else:
+        job_runner.metrics_port = port
+        task = asyncio.create_task(job_runner.main())
+
+    base_url = f"http://127.0.0.1:{port}"
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as http:
+        live = await _wait_for(http, "/health/live", timeout)
+        ready = await _wait_for(http, "/health/ready", timeout)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    return {"import_s": imported, "live_s": live, "ready_s": ready}
+
+
+def _run_child(service: str, args) -> dict:
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", service, "--port", str(args.port)],
+        check=True,
+        capture_output=True,
+        text=True,
+        timeout=args.timeout + 30,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_s"] = time.perf_counter() - started
+    return result
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def _setup_environment(workdir: str):
+    """Must be done before anything imports tools.database (children inherit it)."""
+    os.environ["DATABASE_URL"] = f"sqlite:///{workdir}/startup.db"
+    os.environ["MESSAGE_TRANSPORT"] = "memory"
+    os.environ["STATUS_FANOUT"] = "kafka"  # Through the transport: no Redis pub/sub
+    os.environ.pop("TRACE_FILE", None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5, help="Processes started per service")
+    parser.add_argument("--max-ready", type=float, default=None, help="Seconds. Fail if slower")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--output", type=Path, default=None, help="Where to save the JSON")
+    parser.add_argument("--child", choices=SERVICES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    sys.path[:0] = [
+        str(REPO_ROOT / "benchmarks"),
+        str(REPO_ROOT / "backend"),
+        str(REPO_ROOT / "worker"),
+    ]
+
+    if args.child:
+        # Quiet: the parent reads the result from our last line
+        import logging
+
+        import structlog
+
+        structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.CRITICAL))
+        result = asyncio.run(_child(args.child, args.port, args.timeout))
+        print(json.dumps(result))
+        return
+
+    workdir = tempfile.mkdtemp(prefix="fthm_startup_")
+    _setup_environment(workdir)
+    subprocess.run([sys.executable, "-m", "app.migrate"], cwd=REPO_ROOT / "backend", check=True)
+
+    results = {}
+    for service in SERVICES:
+        runs = [_run_child(service, args) for _ in range(args.runs)]
+        results[service] = {
+            key: round(statistics.median(run[key] for run in runs), 4) for key in runs[0]
+        }
+        print(f"{service:>8}: {results[service]}")
+
+    commit = _git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "parameters": {k: v for k, v in vars(args).items() if k not in ("output", "child")},
+        "results": results,
+    }
+    output = args.output
+    if output is None:
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = RESULTS_DIR / f"startup-{stamp}-{commit or 'nocommit'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, default=str))
+    print(f"Results saved to {output}")
+
+    if args.max_ready is not None:
+        slow = {s: r["ready_s"] for s, r in results.items() if r["ready_s"] > args.max_ready}
+        if slow:
+            print(f"Slower than {args.max_ready}s to get ready: {slow}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
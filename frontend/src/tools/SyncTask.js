@@ -10,7 +10,8 @@ class SyncTask {
         this.status = status;
         this.onUpdate = onUpdate; // Callback function when status updates
         this.ws = null; // WebSocket instance
-        this.pollingInterval = null; // Polling interval ID
+        this.polling = false; // Long polling in progress
+        this.version = null; // Version of this.status (as the backend counts them)
 
         if (this.task_id && !completedStatuses.includes(this.status)) {
             this.startTracking();
@@ -33,7 +34,13 @@ class SyncTask {
             this.ws.onopen = () => console.log(`WebSocket connected for task ${this.task_id} at URL ${this.ws.url}`);
 
             this.ws.onmessage = (event) => {
-                const {task_id, status} = JSON.parse(event.data);
+                const data = JSON.parse(event.data);
+                if (data.type === "ping") {
+                    this.ws.send(JSON.stringify({action: "pong"})); // Or the server drops us
+                    return;
+                }
+
+                const {task_id, status} = data;
                 console.log(`Received status update to ${status} for task ${task_id}/${this.task_id}`);
 
                 if (task_id !== this.task_id) {
@@ -42,6 +49,7 @@ class SyncTask {
                 }
 
                 this.status = status;
+                this.version = data.version ?? this.version;
                 this.onUpdate(this);
 
                 if (completedStatuses.includes(status)) {
@@ -76,8 +84,10 @@ class SyncTask {
     }
 
     async fetchStatus() {
+        // Once we know a version, the backend holds the request until there's a newer one
+        const params = this.version === null ? {} : {wait: 25, since: this.version};
         try {
-            const response = await api.get(`/sync/${this.task_id}/status`);
+            const response = await api.get(`/sync/${this.task_id}/status`, {params});
             return response.data;
         } catch (error) {
             console.error(`Error fetching sync status for task ${this.task_id}:`, error);
@@ -85,12 +95,20 @@ class SyncTask {
         }
     }
 
-    startPolling() {
-        if (this.pollingInterval) return;
+    async startPolling() {
+        if (this.polling) return;
 
         console.log(`Starting polling for task ${this.task_id}`);
-        this.pollingInterval = setInterval(async () => {
+        this.polling = true;
+        while (this.polling) {
             const data = await this.fetchStatus();
+            if (!this.polling) return;
+            if (data.status === "error") {
+                await new Promise((resolve) => setTimeout(resolve, 1000)); // Don't hammer it
+                continue;
+            }
+
+            this.version = data.version;
             if (data.status !== this.status) {
                 this.status = data.status;
                 this.onUpdate(this);
@@ -100,7 +118,7 @@ class SyncTask {
                 console.log(`Task ${this.task_id} is completed (${data.status}), stopping polling.`);
                 this.stopTracking();
             }
-        }, 1000);
+        }
     }
 
     stopTracking() {
@@ -112,10 +130,9 @@ class SyncTask {
         }
 
         // Stop polling if it exists
-        if (this.pollingInterval) {
+        if (this.polling) {
             console.log(`Stopping polling for task ${this.task_id}`);
-            clearInterval(this.pollingInterval);
-            this.pollingInterval = null;
+            this.polling = false;
         }
     }
 }
@@ -0,0 +1,130 @@
+"""
+Moves finished sync tasks (completed or failed) not updated in SYNC_TASK_RETENTION_DAYS to
+the sync_tasks_archive table (see app.models.ArchivedSyncTask), so sync_tasks only holds
+the recent ones and the queries on it don't get slower as history piles up.
+It goes in batches of ARCHIVE_BATCH_SIZE, each one its own short transaction, pausing
+ARCHIVE_BATCH_PAUSE_MS between them: no long locks, and the rest of the traffic gets its
+turn. Rows are locked with SKIP LOCKED, so several archivers can run at the same time.
+GET /sync is unaffected (latest_sync_tasks keeps the entries of archived tasks), and
+GET /sync/{task_id}/status finds them with include_archived=true.
+
+It runs as part of job_runner's main() (first process only), but it can also run on its own:
+    python /worker/archiver.py [--once]
+"""
+
+import argparse
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+import structlog
+
+from app.models import ArchivedSyncTask, SyncTask
+from tools import constants, metrics
+from tools.database import actx_db
+
+log = structlog.get_logger()
+
+SYNC_TASK_RETENTION_DAYS = float(os.getenv("SYNC_TASK_RETENTION_DAYS", default="30"))  # 0: off
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", default="1000"))
+ARCHIVE_BATCH_PAUSE_MS = float(os.getenv("ARCHIVE_BATCH_PAUSE_MS", default="50"))
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", default="3600"))
+
+sync_tasks_archived = metrics.counter("sync_tasks_archived_total", "Sync tasks archived")
+
+_archived_columns = [
+    "id",
+    "user_id",
+    "meeting_id",
+    "status",
+    "status_version",
+    "created_at",
+    "updated_at",
+    "archived_at",
+]
+
+
+async def archive_batch(cutoff: datetime, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Archive up to 'batch_size' tasks finished before 'cutoff'. Returns how many."""
+    async with actx_db() as db:
+        task_ids = list(
+            await db.scalars(
+                sa.select(SyncTask.id)
+                .where(
+                    SyncTask.status.in_(constants.finished_statuses),
+                    SyncTask.updated_at < cutoff,
+                )
+                .order_by(SyncTask.updated_at)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+        )
+        if not task_ids:
+            return 0
+
+        rows = sa.select(
+            SyncTask.id,
+            SyncTask.user_id,
+            SyncTask.meeting_id,
+            SyncTask.status,
+            SyncTask.status_version,
+            SyncTask.created_at,
+            SyncTask.updated_at,
+            sa.literal(datetime.utcnow(), sa.DateTime),
+        ).where(SyncTask.id.in_(task_ids))
+        await db.execute(sa.insert(ArchivedSyncTask).from_select(_archived_columns, rows))
+        await db.execute(sa.delete(SyncTask).where(SyncTask.id.in_(task_ids)))
+        await db.commit()
+    sync_tasks_archived.inc(len(task_ids))
+    return len(task_ids)
+
+
+async def archive_finished_tasks(retention_days: float = SYNC_TASK_RETENTION_DAYS) -> int:
+    """Archive everything past the retention period, batch by batch. Returns how many."""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    total = 0
+    while True:
+        archived = await archive_batch(cutoff)
+        total += archived
+        if archived < ARCHIVE_BATCH_SIZE:
+            break
+        await asyncio.sleep(ARCHIVE_BATCH_PAUSE_MS / 1000)
+    if total:
+        log.info("Archived finished sync tasks", count=total, cutoff=cutoff.isoformat())
+    return total
+
+
+async def run_archiver():
+    """Archive every ARCHIVE_INTERVAL_SECONDS, forever (unless retention is off)."""
+    if SYNC_TASK_RETENTION_DAYS <= 0:
+        log.info("Sync task archiving is off (SYNC_TASK_RETENTION_DAYS)")
+        return
+    log.info(
+        "Starting sync task archiver",
+        retention_days=SYNC_TASK_RETENTION_DAYS,
+        batch_size=ARCHIVE_BATCH_SIZE,
+    )
+    while True:
+        try:
+            await archive_finished_tasks()
+        except Exception:
+            log.exception("Exception archiving sync tasks")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Archive finished sync tasks")
+    parser.add_argument("--once", action="store_true", help="Archive what's due, then exit")
+    args = parser.parse_args()
+    if args.once and SYNC_TASK_RETENTION_DAYS > 0:
+        await archive_finished_tasks()
+    elif not args.once:
+        await run_archiver()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        log.info("Shutting down gracefully...")
@@ -1,23 +1,68 @@
 import asyncio
 import json
+import multiprocessing
+import os
 import random
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import structlog
 
-from app.models import SyncTask
-from tools import constants
+import retries
+import stage_cache
+from archiver import run_archiver
+from outbox_relay import relay_outbox
+from status_writer import get_status_writer, stop_status_writer
+from tools import constants, database, envelope, health, metrics
 from tools import util_redis
-from tools.database import ctx_db
-from tools.kafka import produce_message, consume_messages
+from tools.kafka import produce_message, consume_concurrently, start_producer, stop_producer
 
 log = structlog.get_logger()
 
+# How many tasks each stage works on at the same time (JOBA_CONCURRENCY, JOBB_CONCURRENCY...)
+stage_concurrency = {
+    job_name: int(os.getenv(f"{job_name.upper()}_CONCURRENCY", default="8"))
+    for job_name in ("jobA", "jobB", "jobC")
+}
+
+# How long _simulate_work pretends each stage takes
+simulated_work_seconds = float(os.getenv("SIMULATED_WORK_SECONDS", default="2"))
+
+# When > 0, CPU-bound stage bodies run in a pool of that many processes, so they don't
+# freeze this process' event loop (and with it, every consumer in it)
+cpu_pool_size = int(os.getenv("WORKER_CPU_POOL_SIZE", default="0"))
+_cpu_pool: ProcessPoolExecutor | None = None
+
+# /metrics (and /health/live, /health/ready) are served on WORKER_METRICS_PORT + the
+# process' slot (see supervisor.py). 0: don't
+metrics_port = int(os.getenv("WORKER_METRICS_PORT", default="9100"))
+
+stage_seconds = metrics.histogram(
+    "stage_seconds",
+    "How long a stage takes (outcome: ok, cached or failed)",
+    ["stage", "outcome"],
+)
+
+
+async def run_cpu_bound(func, *args):
+    """Run func(*args) in the CPU pool (if enabled) or just inline, and return its result."""
+    global _cpu_pool
+    if cpu_pool_size <= 0:
+        return func(*args)
+    if _cpu_pool is None:
+        _cpu_pool = ProcessPoolExecutor(
+            max_workers=cpu_pool_size, mp_context=multiprocessing.get_context("spawn")
+        )
+    return await asyncio.get_running_loop().run_in_executor(_cpu_pool, func, *args)
+
 
 async def update_task_status(task_id: int, status: str):
     """Does all the things when a task status is updated:
     - Set/update the Redis cache entry
     - Update the Database row
     - Publish the status via kafka for whomever wants to listen
+    Returns once all of that has been done (see status_writer.StatusWriter)
     """
     try:
         task_id = int(task_id)
@@ -27,97 +72,182 @@ async def update_task_status(task_id: int, status: str):
     if not status:
         raise ValueError(f"status can't be empty (when updating task_id={task_id}")
 
-    # Update redis cache ASAP. This can potentially lower DB accesses
-    redis_client = util_redis.get_client()
-    cache_key = util_redis.task_status_key(task_id)
-    redis_client.set(cache_key, status, ex=60 * 60 * 5)
-
-    # Update the value in the database:
-    with ctx_db() as db:
-        db.query(SyncTask).filter(SyncTask.id == task_id).update({SyncTask.status: status})
-        db.commit()
-
-    # Now, push a Kafka message in the 'status_updates' topic to let the world know that
-    # the status has changed
-    message = json.dumps({"task_id": task_id, "status": status})
-    log.info(
-        "Pushing task status change",
-        task_id=task_id,
-        new_status=status,
-        topic=constants.status_updates_topic,
-    )
-    await produce_message(constants.status_updates_topic, message)
+    # The Redis cache entry, the DB row and the 'status_updates' message are written by the
+    # status writer, batched together with other tasks' changes from the last few ms.
+    await get_status_writer().write(task_id, status)
 
 
-async def _simulate_work(task_data, *, job_name: str):
+async def _simulate_work(task_data, *, job_name: str) -> dict:
+    """
+    Run the stage and return its result. If the stage cache (see stage_cache.py) already has
+    a result for the same inputs, that one is returned instead: no work done.
+    """
     log.info(f"Got message from Kafka topic '{job_name}'", task_data=task_data)
     task_id = task_data["task_id"]
-    await update_task_status(task_id, job_name)
-    # Pretend to take some time:
-    await asyncio.sleep(2)
+    started_at, outcome = time.perf_counter(), "failed"
+    try:
+        await update_task_status(task_id, job_name)
+        cache = stage_cache.get_stage_cache()
+        if cache and (cached := await cache.get(job_name, task_data)) is not None:
+            outcome = "cached"
+            return json.loads(cached)
+        # Pretend to take some time:
+        await asyncio.sleep(simulated_work_seconds)
+        result = await run_cpu_bound(_crunch, task_data, job_name)
+        if cache:
+            await cache.put(job_name, task_data, json.dumps(result, sort_keys=True))
+        outcome = "ok"
+        return result
+    finally:
+        stage_seconds.observe(time.perf_counter() - started_at, stage=job_name, outcome=outcome)
+
+
+def _crunch(task_data, job_name: str) -> dict:
+    """
+    The synchronous (CPU-bound) part of a stage, returning its result. Must be a module-level
+    function taking picklable arguments (and returning a picklable, JSON-able result), because
+    it may run in another process (see run_cpu_bound) and its result may be cached.
+    """
     if random.randint(0, 10) == 0:
         raise Exception(f"boooooOOOOOOm in {job_name}!!!")
+    return {
+        "stage": job_name,
+        "meeting_id": task_data["meeting_id"],
+        "meeting_version": task_data.get("meeting_version"),
+    }
 
 
-async def process_jobA():
-    """Kafka consumer for JobA."""
-    async for message in consume_messages(constants.start_topic):
-        task_data = json.loads(message)
-        task_id = task_data["task_id"]
+async def _run_stage(message, headers: dict[str, str], *, job_name: str) -> dict | None:
+    """
+    Run the stage on the task of 'message'. Returns its result if it went fine (None if it
+    didn't). If it didn't, the message was sent to be retried later (see retries.py) or, out
+    of retries, to the dead letter topic (and the task marked as failed). If that can't be
+    sent (the broker's down...), the task is just marked as failed: better than leaving it
+    in progress forever (and its meeting unable to sync again).
+    """
+    task_data = envelope.decode(message)
+    task_id = task_data["task_id"]
+    try:
+        result = await _simulate_work(task_data, job_name=job_name)
+        return result if result is not None else {}  # None is for failures
+    except Exception as e:
         try:
-            await _simulate_work(task_data, job_name="jobA")
+            retrying = await retries.retry_or_dead_letter(job_name, message, headers, e)
         except Exception:
-            log.exception("Exception while processing jobA", task_id=task_id)
+            log.exception(
+                "Couldn't retry or dead letter the stage", stage=job_name, task_id=task_id
+            )
+            retrying = False
+        if not retrying:
             await update_task_status(task_id, constants.failed_status)
-        else:
-            await produce_message("jobB", message)
+        return None
+
+
+def _with_result(message, result: dict):
+    """'message', carrying the stage's result to the next stage (part of its inputs)."""
+    task_data = envelope.decode(message)
+    return envelope.encode_task(
+        task_data["task_id"],
+        task_data["meeting_id"],
+        task_data["status"],
+        task_data.get("meeting_version"),
+        json.dumps(result, sort_keys=True),
+    )
+
+
+async def handle_jobA(message, headers: dict[str, str]):
+    if (result := await _run_stage(message, headers, job_name="jobA")) is not None:
+        await produce_message("jobB", _with_result(message, result))
+
+
+async def handle_jobB(message, headers: dict[str, str]):
+    if (result := await _run_stage(message, headers, job_name="jobB")) is not None:
+        await produce_message("jobC", _with_result(message, result))
+
+
+async def handle_jobC(message, headers: dict[str, str]):
+    if await _run_stage(message, headers, job_name="jobC") is not None:
+        # Mark completed
+        await update_task_status(envelope.decode(message)["task_id"], constants.completed_status)
+
+
+async def process_jobA():
+    """Kafka consumer for JobA."""
+    await consume_concurrently(
+        constants.start_topic,
+        handle_jobA,
+        max_in_flight=stage_concurrency["jobA"],
+        with_headers=True,
+    )
 
 
 async def process_jobB():
     """Kafka consumer for JobB."""
-    async for message in consume_messages("jobB"):
-        task_data = json.loads(message)
-        task_id = task_data["task_id"]
-        try:
-            await _simulate_work(task_data, job_name="jobB")
-        except Exception:
-            log.exception("Exception while processing jobB", task_id=task_id)
-            await update_task_status(task_id, constants.failed_status)
-        else:
-            await produce_message("jobC", message)
+    await consume_concurrently(
+        "jobB", handle_jobB, max_in_flight=stage_concurrency["jobB"], with_headers=True
+    )
 
 
 async def process_jobC():
     """Kafka consumer for JobC."""
-    async for message in consume_messages("jobC"):
-        task_data = json.loads(message)
-        task_id = task_data["task_id"]
-        try:
-            await _simulate_work(task_data, job_name="jobC")
-        except Exception:
-            log.exception("Exception while processing jobC", task_id=task_id)
-            await update_task_status(task_id, constants.failed_status)
-        else:
-            # Mark completed
-            await update_task_status(task_id, constants.completed_status)
+    await consume_concurrently(
+        "jobC", handle_jobC, max_in_flight=stage_concurrency["jobC"], with_headers=True
+    )
 
 
-async def main():
-    """Run job consumers concurrently."""
-    await asyncio.gather(process_jobA(), process_jobB(), process_jobC())
+async def main(slot: int = 0):
+    """
+    Run job consumers (and the outbox relay and, in the first process, the archiver)
+    concurrently. The producer and the DB pool warm up alongside them: /health/ready (next
+    to /metrics) tells when they're done.
+    """
+    health.add_probe("db", database.ping)
+    health.add_probe("redis", util_redis.ping)
+    loops = [
+        health.warm_up("producer", start_producer),
+        health.warm_up("db_pool", database.warm_up),
+        process_jobA(),
+        process_jobB(),
+        process_jobC(),
+        *(retries.run_retry_scheduler(stage) for stage in retries.STAGES),
+        relay_outbox(),
+    ]
+    if slot == 0:
+        loops.append(run_archiver())  # One per host is plenty (and they don't collide anyway)
+    if metrics_port:
+        loops.append(metrics.serve_metrics(metrics_port + slot, routes=health.http_routes()))
+    try:
+        await asyncio.gather(*loops)
+    finally:
+        await stop_status_writer()
+        await stop_producer()
+        await util_redis.close_async_client()
 
 
-if __name__ == "__main__":
-    log.info("Starting processing Kafka messages.")
+def run(slot: int = 0):
+    """
+    Run main() until it's done or until we get a SIGTERM/SIGINT. On those, the consumers
+    are cancelled, finish whatever they were working on (and commit it) and we exit.
+    'slot' tells apart the processes of the same supervisor (see supervisor.py).
+    """
+    log.info("Starting processing Kafka messages.", pid=os.getpid(), slot=slot)
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    main_task = loop.create_task(main(slot))
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, main_task.cancel)
     try:
-        loop.run_until_complete(main())
-    except KeyboardInterrupt:
-        log.info("Shutting down gracefully...")
+        loop.run_until_complete(main_task)
+    except asyncio.CancelledError:
+        log.info("Shutting down gracefully...", pid=os.getpid())
     except Exception:
         log.exception("Exception occurred in main()")
-        loop.close()
         raise
     finally:
+        if _cpu_pool is not None:
+            _cpu_pool.shutdown(cancel_futures=True)
         loop.close()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,94 @@
+"""
+Publishes the messages written to the outbox table (see app.models.OutboxMessage) to Kafka,
+in batches, and deletes them once the broker has acknowledged them.
+Rows are locked with SKIP LOCKED, so several relays (one per worker process, for
+instance) can run at the same time without publishing the same row twice... Mostly: if
+we crash between the broker ack and the DELETE, the batch is published again. At least once.
+
+It runs as part of job_runner's main(), but it can also run on its own:
+    python /worker/outbox_relay.py
+"""
+
+import asyncio
+import json
+import os
+
+import sqlalchemy as sa
+import structlog
+
+from app.models import OutboxMessage
+from tools import envelope
+from tools.database import actx_db
+from tools.kafka import produce_message, start_producer, stop_producer
+
+log = structlog.get_logger()
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", default="500"))
+OUTBOX_POLL_MS = float(os.getenv("OUTBOX_POLL_MS", default="100"))  # When the outbox is empty
+
+
+async def relay_batch(batch_size: int = OUTBOX_BATCH_SIZE) -> int:
+    """Publish (and delete) up to 'batch_size' outbox messages. Returns how many."""
+    async with actx_db() as db:
+        messages = (
+            await db.scalars(
+                sa.select(OutboxMessage)
+                .order_by(OutboxMessage.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+        ).all()
+        if not messages:
+            return 0
+
+        # Everything goes to the producer's buffer first, then we wait for all the acks.
+        # Payloads are saved as JSON (the outbox is a text column), and sent in whatever
+        # format producers should use. The saved headers keep the trace (and the time spent
+        # in the outbox counts as waiting in the queue).
+        deliveries = [
+            await produce_message(
+                message.topic,
+                envelope.transcode(message.payload),
+                wait=False,
+                headers=json.loads(message.headers) if message.headers else None,
+            )
+            for message in messages
+        ]
+        await asyncio.gather(*deliveries)
+
+        await db.execute(
+            sa.delete(OutboxMessage).where(OutboxMessage.id.in_([m.id for m in messages]))
+        )
+        await db.commit()
+    log.info("Relayed outbox messages", count=len(messages))
+    return len(messages)
+
+
+async def relay_outbox():
+    """Relay outbox messages forever."""
+    log.info("Starting outbox relay", batch_size=OUTBOX_BATCH_SIZE)
+    while True:
+        try:
+            relayed = await relay_batch()
+        except Exception:
+            log.exception("Exception relaying outbox messages")
+            await asyncio.sleep(1)
+            continue
+        if relayed < OUTBOX_BATCH_SIZE:
+            # Caught up. If it was a full batch, there's probably more: don't wait.
+            await asyncio.sleep(OUTBOX_POLL_MS / 1000)
+
+
+async def main():
+    await start_producer()
+    try:
+        await relay_outbox()
+    finally:
+        await stop_producer()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        log.info("Shutting down gracefully...")
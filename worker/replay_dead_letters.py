@@ -0,0 +1,135 @@
+"""
+Sends the messages of the dead letter topic (stage messages that ran out of retries, see
+retries.py) back to the stage they failed in, with a fresh set of attempts. For when
+whatever made them fail has been fixed:
+    python /worker/replay_dead_letters.py [--limit 100] [--idle-seconds 5] [--join-timeout 60]
+It stops after --limit messages, or once there's nothing new for --idle-seconds (counted from
+when its consumer joined the group, which can take a while with Kafka). Messages
+are acknowledged as they're replayed, so running it again picks up where it left off.
+Only tasks still failed are replayed: not archived ones, nor the ones of a meeting with
+another sync in progress (a meeting only has one at a time, see start_sync_task). Those
+are skipped (and acknowledged).
+"""
+
+import argparse
+import asyncio
+import time
+
+import sqlalchemy as sa
+import structlog
+
+from app.models import SyncTask
+from tools import constants, envelope, health
+from tools.database import actx_db
+from tools.kafka import consume_messages, produce_message, stop_producer
+from tools.transport import consumer_component
+
+log = structlog.get_logger()
+
+REPLAY_GROUP_ID = "dead_letter_replay"
+
+
+async def _why_not_replayable(task_id: int | None) -> str | None:
+    """Why the task can't go through the pipeline again (None: it can)."""
+    if task_id is None:
+        return "no task_id"
+    async with actx_db() as db:
+        task = await db.get(SyncTask, task_id)
+        if task is None:
+            return "task not found (archived?)"
+        if task.status != constants.failed_status:
+            return f"task is {task.status}, not failed"
+        in_progress = await db.scalar(
+            sa.select(
+                sa.exists().where(
+                    SyncTask.meeting_id == task.meeting_id,
+                    SyncTask.user_id == task.user_id,
+                    SyncTask.id != task.id,
+                    SyncTask.status.notin_(constants.finished_statuses),
+                )
+            )
+        )
+        return "another sync of the meeting is in progress" if in_progress else None
+
+
+async def _joined(component: str, next_message: asyncio.Future, timeout: float):
+    """Wait until the consumer joined its group (or got a message already)."""
+    deadline = time.monotonic() + timeout
+    while not (health.is_ready(component) or next_message.done()):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"The dead letters consumer didn't join in {timeout}s")
+        await asyncio.sleep(0.05)
+
+
+async def _replay_one(message, headers: dict[str, str]) -> int:
+    """Send the dead letter back to its stage, if it can be. Returns how many were (0 or 1)."""
+    stage = headers.get("stage")
+    if not stage:
+        log.warning("Dead letter without a stage. Skipping it", headers=headers)
+        return 0
+    task_id = envelope.decode(message).get("task_id")
+    if reason := await _why_not_replayable(task_id):
+        log.warning("Dead letter not replayable. Skipping it", task_id=task_id, reason=reason)
+        return 0
+    await produce_message(stage, message, headers={"replayed_from": "dead_letters"})
+    log.info(
+        "Replayed dead letter",
+        stage=stage,
+        task_id=task_id,
+        attempts=headers.get("attempts"),
+        error=headers.get("error"),
+    )
+    return 1
+
+
+async def replay(
+    limit: int | None = None, idle_seconds: float = 5, join_timeout: float = 60
+) -> int:
+    """Replay (up to 'limit') dead letters. Returns how many."""
+    messages = consume_messages(
+        constants.dead_letter_topic, group_id=REPLAY_GROUP_ID, with_headers=True
+    )
+    next_message = asyncio.ensure_future(anext(messages))
+    replayed = 0
+    try:
+        await _joined(
+            consumer_component(constants.dead_letter_topic, REPLAY_GROUP_ID),
+            next_message,
+            join_timeout,
+        )
+        while True:
+            try:
+                message, headers = await asyncio.wait_for(next_message, idle_seconds)
+            except (asyncio.TimeoutError, StopAsyncIteration):
+                break  # Caught up
+            if limit is not None and replayed >= limit:
+                break  # Not acknowledged: it stays for the next run
+            replayed += await _replay_one(message, headers)
+            # Asking for the next message is what acknowledges this one
+            next_message = asyncio.ensure_future(anext(messages))
+    finally:
+        next_message.cancel()
+        await asyncio.gather(next_message, return_exceptions=True)
+        await messages.aclose()
+    return replayed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay dead lettered stage messages")
+    parser.add_argument("--limit", type=int, default=None, help="At most this many")
+    parser.add_argument(
+        "--idle-seconds", type=float, default=5, help="Stop after this long with nothing new"
+    )
+    parser.add_argument(
+        "--join-timeout", type=float, default=60, help="Give up if not consuming by then"
+    )
+    args = parser.parse_args()
+    try:
+        replayed = await replay(args.limit, args.idle_seconds, args.join_timeout)
+    finally:
+        await stop_producer()
+    log.info("Done replaying dead letters", replayed=replayed)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
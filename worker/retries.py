@@ -0,0 +1,143 @@
+"""
+Delayed retries and dead letters for the pipeline stages (jobA, jobB, jobC).
+When a stage fails, retry_or_dead_letter() sends its message to the stage's retry topic
+("<stage>.retry") with the attempt number and when to retry it (retry_at) in the headers.
+run_retry_scheduler() consumes that topic with up to RETRY_MAX_SCHEDULED messages in flight,
+each one waiting until its retry_at and then going back to the stage's topic. That way the
+waiting happens on its own consumer (its messages are acknowledged once re-sent, so a
+restart doesn't lose them) and the stage's consumer keeps working on other tasks.
+Once a stage runs out of attempts, the message goes to the dead letter topic
+(constants.dead_letter_topic), with the stage, attempts and error in its headers. See
+replay_dead_letters.py to send them back through the pipeline.
+
+Policies are per stage: <STAGE>_MAX_ATTEMPTS, <STAGE>_RETRY_BACKOFF_SECONDS and
+<STAGE>_RETRY_MAX_BACKOFF_SECONDS (like JOBA_MAX_ATTEMPTS), falling back to
+STAGE_MAX_ATTEMPTS, RETRY_BACKOFF_SECONDS and RETRY_MAX_BACKOFF_SECONDS.
+"""
+
+import asyncio
+import os
+import random
+import time
+
+import structlog
+
+from tools import constants, metrics
+from tools.kafka import consume_concurrently, produce_message
+from tools.transport import Payload
+
+log = structlog.get_logger()
+
+STAGES = ("jobA", "jobB", "jobC")
+
+# How many retries each stage's scheduler keeps waiting at the same time
+RETRY_MAX_SCHEDULED = int(os.getenv("RETRY_MAX_SCHEDULED", default="1000"))
+
+stage_retries = metrics.counter("stage_retries_total", "Stage failures sent to retry", ["stage"])
+dead_letters = metrics.counter("dead_letters_total", "Stage failures out of retries", ["stage"])
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int, backoff_seconds: float, max_backoff_seconds: float):
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+    @classmethod
+    def from_env(cls, stage: str) -> "RetryPolicy":
+        def setting(name: str, fallback: str, default: str) -> str:
+            return os.getenv(f"{stage.upper()}_{name}") or os.getenv(fallback, default=default)
+
+        return cls(
+            max_attempts=int(setting("MAX_ATTEMPTS", "STAGE_MAX_ATTEMPTS", "3")),
+            backoff_seconds=float(setting("RETRY_BACKOFF_SECONDS", "RETRY_BACKOFF_SECONDS", "1")),
+            max_backoff_seconds=float(
+                setting("RETRY_MAX_BACKOFF_SECONDS", "RETRY_MAX_BACKOFF_SECONDS", "60")
+            ),
+        )
+
+    def delay(self, attempt: int) -> float:
+        """
+        Seconds to wait before 'attempt' (2 is the first retry): exponential, capped, with
+        jitter (anywhere between half and all of it), so failures together don't retry together.
+        """
+        delay = min(self.backoff_seconds * 2 ** (attempt - 2), self.max_backoff_seconds)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+retry_policies = {stage: RetryPolicy.from_env(stage) for stage in STAGES}
+
+
+def retry_topic(stage: str) -> str:
+    return f"{stage}.retry"
+
+
+def attempt_of(headers: dict[str, str]) -> int:
+    """Which attempt (1 being the first) the message with these headers is."""
+    try:
+        return int(headers.get("attempt", 1))
+    except ValueError:
+        return 1
+
+
+async def retry_or_dead_letter(
+    stage: str, message: Payload, headers: dict[str, str], error: Exception
+) -> bool:
+    """
+    'stage' failed on 'message'. Schedule a retry, if it has attempts left (returns True), or
+    send it to the dead letter topic (returns False: the task is done for).
+    """
+    policy = retry_policies[stage]
+    attempt = attempt_of(headers)
+    if attempt < policy.max_attempts:
+        delay = policy.delay(attempt + 1)
+        await produce_message(
+            retry_topic(stage),
+            message,
+            headers={
+                "stage": stage,
+                "attempt": str(attempt + 1),
+                "retry_at": repr(time.time() + delay),
+                "error": repr(error)[:1000],
+            },
+        )
+        stage_retries.inc(stage=stage)
+        log.warning(
+            "Stage failed. Retrying later",
+            stage=stage,
+            attempt=attempt,
+            retry_in=round(delay, 3),
+            error=repr(error),
+        )
+        return True
+
+    await produce_message(
+        constants.dead_letter_topic,
+        message,
+        headers={
+            "stage": stage,
+            "attempts": str(attempt),
+            "error": repr(error)[:1000],
+            "error_type": type(error).__name__,
+            "failed_at": repr(time.time()),
+        },
+    )
+    dead_letters.inc(stage=stage)
+    log.error("Stage out of retries. Dead lettered", stage=stage, attempts=attempt, exc_info=error)
+    return False
+
+
+async def run_retry_scheduler(stage: str):
+    """Send the messages of the stage's retry topic back to the stage once they're due."""
+
+    async def reschedule(message: Payload, headers: dict[str, str]):
+        try:
+            retry_at = float(headers.get("retry_at", 0))
+        except ValueError:
+            retry_at = 0
+        await asyncio.sleep(max(retry_at - time.time(), 0))
+        await produce_message(stage, message, headers={"attempt": headers.get("attempt", "2")})
+
+    await consume_concurrently(
+        retry_topic(stage), reschedule, max_in_flight=RETRY_MAX_SCHEDULED, with_headers=True
+    )
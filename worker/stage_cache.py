@@ -0,0 +1,244 @@
+"""
+Cache of the pipeline stages' results, so re-syncing a meeting that didn't change since its
+last successful sync doesn't run the (expensive) stages all over again: a stage whose inputs
+are the same as last time takes its result from here and the task moves on to the next one.
+A stage's cache key is the stage, the meeting and a fingerprint of its inputs (see
+stage_inputs): the version of the meeting's data the task syncs (meeting_version, from
+whoever started it) and the previous stage's result (which each stage passes on to the next
+one in the task's message). Tasks without a meeting_version aren't cached: nothing tells
+whether the meeting changed. Results are content-addressed: stored under the digest of what's in them, with
+the cache key pointing to that digest, so identical results are only stored once.
+Only successful results are cached. Bump a stage's STAGE_VERSIONS entry when what it does
+changes, and its cached results are ignored from then on.
+
+STAGE_CACHE picks where they go:
+- "off" (default): nowhere, stages always run
+- "redis": Redis, for STAGE_CACHE_TTL_SECONDS. Size-based eviction is Redis' own
+  (maxmemory with an LRU maxmemory-policy)
+- "disk": files in STAGE_CACHE_DIR (shared by the processes of the host), the least
+  recently used ones removed once they're over STAGE_CACHE_MAX_BYTES
+A cache that doesn't work (Redis down, disk full...) is just a miss: never a failed stage.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import structlog
+
+from tools import util_redis
+
+log = structlog.get_logger()
+
+STAGE_CACHE = os.getenv("STAGE_CACHE", default="off")
+STAGE_CACHE_TTL_SECONDS = int(os.getenv("STAGE_CACHE_TTL_SECONDS", default=str(7 * 24 * 3600)))
+STAGE_CACHE_DIR = os.getenv("STAGE_CACHE_DIR", default="/tmp/fthm_stage_cache")
+STAGE_CACHE_MAX_BYTES = int(os.getenv("STAGE_CACHE_MAX_BYTES", default=str(256 * 1024 * 1024)))
+
+# Part of every cache key: change a stage's version and its old results don't count anymore
+STAGE_VERSIONS = {"jobA": 1, "jobB": 1, "jobC": 1}
+
+
+def stage_inputs(stage: str, task_data: dict) -> dict | None:
+    """
+    What the result of 'stage' for the task depends on, or None if we can't tell (then it's
+    not cached): the meeting's data, by its version, and the previous stage's result.
+    """
+    if task_data.get("meeting_version") is None:
+        return None
+    upstream = task_data.get("result")
+    return {
+        "meeting_id": task_data["meeting_id"],
+        "meeting_version": task_data["meeting_version"],
+        "upstream": _digest(upstream) if upstream is not None else None,
+    }
+
+
+def cache_key(stage: str, task_data: dict) -> str | None:
+    inputs = stage_inputs(stage, task_data)
+    if inputs is None:
+        return None
+    fingerprint = _digest(json.dumps(inputs, sort_keys=True, separators=(",", ":")))[:32]
+    return f"{stage}:v{STAGE_VERSIONS.get(stage, 0)}:{task_data['meeting_id']}:{fingerprint}"
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+class RedisStageCache:
+    name = "redis"
+
+    @staticmethod
+    def _key(key: str) -> str:
+        return f"stage-result-key_{key}"
+
+    @staticmethod
+    def _result(digest: str) -> str:
+        return f"stage-result_{digest}"
+
+    async def get(self, key: str) -> str | None:
+        client = util_redis.get_async_client()
+        digest = await client.get(self._key(key))
+        return await client.get(self._result(digest)) if digest else None
+
+    async def put(self, key: str, value: str):
+        digest = _digest(value)
+        async with util_redis.get_async_client().pipeline(transaction=False) as pipe:
+            pipe.set(self._result(digest), value, ex=STAGE_CACHE_TTL_SECONDS)
+            pipe.set(self._key(key), digest, ex=STAGE_CACHE_TTL_SECONDS)
+            await pipe.execute()
+
+
+class DiskStageCache:
+    """
+    <dir>/results/<digest> has the results and <dir>/keys/<digest of the key> the digest of
+    the key's result. Reads touch the files, so their mtime tells the least recently used.
+    Writes go to a temporary file first: a reader never sees half a result.
+    Looking for what to evict means going through the whole directory, so it's only done when
+    what this process wrote since last time could have taken it over the limit, or every
+    EVICT_CHECK_SECONDS (for what the other processes wrote).
+    """
+
+    EVICT_CHECK_SECONDS = 60
+
+    name = "disk"
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.results = Path(directory) / "results"
+        self.keys = Path(directory) / "keys"
+        self.max_bytes = max_bytes
+        self.results.mkdir(parents=True, exist_ok=True)
+        self.keys.mkdir(parents=True, exist_ok=True)
+        self._evicting = False
+        self._size = None  # Total size as of the last check, plus what we wrote since
+        self._checked_at = 0.0
+
+    def _key_path(self, key: str) -> Path:
+        return self.keys / _digest(key)
+
+    def _read(self, key: str) -> str | None:
+        try:
+            digest = self._key_path(key).read_text()
+            result = self.results / digest
+            value = result.read_text()
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        os.utime(result, (now, now))
+        return value
+
+    def _write(self, path: Path, value: str):
+        fd, temporary = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        with os.fdopen(fd, "w") as file:
+            file.write(value)
+        os.replace(temporary, path)
+
+    def _put(self, key: str, value: str):
+        digest = _digest(value)
+        result = self.results / digest
+        if not result.exists():
+            self._write(result, value)
+            if self._size is not None:
+                self._size += len(value.encode())
+        self._write(self._key_path(key), digest)
+
+    def _evict(self):
+        """Remove the least recently used results (and keys) until it all fits again."""
+        if (
+            self._size is not None
+            and self._size <= self.max_bytes
+            and time.monotonic() - self._checked_at < self.EVICT_CHECK_SECONDS
+        ):
+            return
+        self._checked_at = time.monotonic()
+        entries = []
+        for path in self.results.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = self._size = sum(size for _mtime, size, _path in entries)
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        removed = set()
+        for _mtime, size, path in entries:
+            if total <= self.max_bytes * 0.9:  # Some room, or we'd be evicting on every write
+                break
+            path.unlink(missing_ok=True)
+            removed.add(path.name)
+            total -= size
+        self._size = total
+        for path in self.keys.iterdir():  # Keys pointing to removed results
+            try:
+                if path.read_text() in removed:
+                    path.unlink(missing_ok=True)
+            except FileNotFoundError:
+                pass
+        log.info("Evicted stage results", count=len(removed))
+
+    async def get(self, key: str) -> str | None:
+        return await asyncio.to_thread(self._read, key)
+
+    async def put(self, key: str, value: str):
+        await asyncio.to_thread(self._put, key, value)
+        if not self._evicting:
+            self._evicting = True
+            try:
+                await asyncio.to_thread(self._evict)
+            finally:
+                self._evicting = False
+
+
+class StageCache:
+    """The cache of whatever STAGE_CACHE says, errors turned into misses (and logs)."""
+
+    def __init__(self, backend: RedisStageCache | DiskStageCache):
+        self.backend = backend
+
+    async def get(self, stage: str, task_data: dict) -> str | None:
+        key = cache_key(stage, task_data)
+        if key is None:
+            util_redis.cache_lookups.inc(cache=f"stage-result-{stage}", result="uncacheable")
+            return None
+        try:
+            value = await self.backend.get(key)
+        except Exception:
+            log.warning("Couldn't read stage cache", stage=stage, exc_info=True)
+            value = None
+        result = "hit" if value is not None else "miss"
+        util_redis.cache_lookups.inc(cache=f"stage-result-{stage}", result=result)
+        return value
+
+    async def put(self, stage: str, task_data: dict, value: str):
+        key = cache_key(stage, task_data)
+        if key is None:
+            return
+        try:
+            await self.backend.put(key, value)
+        except Exception:
+            log.warning("Couldn't write stage cache", stage=stage, exc_info=True)
+
+
+_stage_cache: StageCache | None = None
+
+
+def get_stage_cache() -> StageCache | None:
+    """The process-wide stage cache, or None if STAGE_CACHE is off."""
+    global _stage_cache
+    if _stage_cache is None and STAGE_CACHE != "off":
+        if STAGE_CACHE == "redis":
+            backend = RedisStageCache()
+        elif STAGE_CACHE == "disk":
+            backend = DiskStageCache(STAGE_CACHE_DIR, STAGE_CACHE_MAX_BYTES)
+        else:
+            raise ValueError(f"Unknown STAGE_CACHE {STAGE_CACHE!r}")
+        _stage_cache = StageCache(backend)
+        log.info("Using stage result cache", backend=STAGE_CACHE)
+    return _stage_cache
@@ -0,0 +1,191 @@
+"""
+Write-behind coalescing of task status changes.
+Instead of doing a Redis SET, a DB UPDATE + COMMIT and a Kafka produce for every single
+status transition, transitions are buffered for (at most) STATUS_FLUSH_MS milliseconds or
+STATUS_BATCH_SIZE entries and then written all together: one UPDATE ... CASE id (plus the
+latest_sync_tasks refresh), one pipelined Redis exchange (cache + pub/sub notifications),
+and a batch of status_updates messages.
+If the same task changes status twice in the same window, only the last one is written.
+"""
+
+import asyncio
+import json
+import os
+
+import sqlalchemy as sa
+import structlog
+
+from app.models import SyncTask, refresh_latest_sync_tasks
+from tools import constants
+from tools import envelope
+from tools import tracing
+from tools import util_redis
+from tools.database import actx_db
+from tools.kafka import produce_message
+
+log = structlog.get_logger()
+
+
+class StatusWriter:
+    def __init__(self, *, max_delay_ms: float = 5, max_batch: int = 500):
+        self.max_delay = max_delay_ms / 1000
+        self.max_batch = max_batch
+        self._pending: dict[int, str] = {}  # task_id to its latest status
+        self._headers: dict[int, dict] = {}  # task_id to the trace headers of that status
+        self._flushed: asyncio.Future | None = None  # Resolves when _pending is written
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._runner: asyncio.Task | None = None
+        self._stopping = False
+
+    def start(self):
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background flusher, writing whatever is still buffered."""
+        if self._runner is None:
+            return
+        self._stopping = True
+        self._has_pending.set()
+        self._batch_full.set()
+        await self._runner
+        self._runner = None
+
+    async def write(self, task_id: int, status: str):
+        """Buffer a status change and wait until it's been written (with its batch)."""
+        if self._runner is None:
+            self.start()
+        self._pending.pop(task_id, None)  # Re-insert: keep batches in "last changed" order
+        self._pending[task_id] = status
+        # The status_updates message will be sent from the flusher's task: take the trace
+        # context (and time) from here
+        self._headers[task_id] = tracing.inject()
+        if self._flushed is None:
+            self._flushed = asyncio.get_running_loop().create_future()
+        flushed = self._flushed
+        self._has_pending.set()
+        if len(self._pending) >= self.max_batch:
+            self._batch_full.set()
+        await asyncio.shield(flushed)
+
+    async def _run(self):
+        while True:
+            await self._has_pending.wait()
+            if self._stopping and not self._pending:
+                return
+            if len(self._pending) < self.max_batch and not self._stopping:
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), timeout=self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush_pending()
+            if self._stopping and not self._pending:
+                return  # stop() set _has_pending, but the flush just cleared it
+
+    async def _flush_pending(self):
+        batch, headers, flushed = self._pending, self._headers, self._flushed
+        self._pending, self._headers, self._flushed = {}, {}, None
+        self._has_pending.clear()
+        self._batch_full.clear()
+        try:
+            await self._flush(batch, headers)
+        except Exception as e:
+            log.exception("Exception writing task statuses", task_ids=list(batch))
+            if flushed is not None:
+                flushed.set_exception(e)
+                flushed.exception()  # Mark it as retrieved: writers might be gone
+        else:
+            if flushed is not None:
+                flushed.set_result(None)
+
+    async def _flush(self, batch: dict[int, str], headers: dict[int, dict]):
+        if not batch:
+            return
+        # Update the values in the database, in one statement and one commit:
+        async with actx_db() as db:
+            await db.execute(
+                sa.update(SyncTask)
+                .where(SyncTask.id.in_(batch))
+                .values(
+                    status=sa.case(batch, value=SyncTask.id),
+                    status_version=SyncTask.status_version + 1,
+                )
+            )
+            await refresh_latest_sync_tasks(db, batch)
+            # Websockets following "all the tasks of a user" need to know whose task it is,
+            # and long-polling clients which version of the status they're looking at
+            rows = await db.execute(
+                sa.select(SyncTask.id, SyncTask.user_id, SyncTask.status_version).where(
+                    SyncTask.id.in_(batch)
+                )
+            )
+            owners, versions = {}, {}
+            for task_id, user_id, version in rows:
+                owners[task_id], versions[task_id] = user_id, version
+            await db.commit()
+
+        # Pub/sub notifications stay JSON (our Redis clients decode everything as text). The
+        # status_updates messages use the binary envelope (see tools.envelope).
+        notifications = {
+            task_id: json.dumps(
+                {
+                    "task_id": task_id,
+                    "status": status,
+                    "version": versions.get(task_id),
+                    "user_id": owners.get(task_id),
+                }
+            )
+            for task_id, status in batch.items()
+        }
+
+        # Update the redis cache and notify the backend replicas whose websockets follow
+        # these tasks (or their users), all in the same round trip
+        async with util_redis.get_async_client().pipeline(transaction=False) as pipe:
+            for task_id, status in batch.items():
+                pipe.set(
+                    util_redis.task_status_key(task_id),
+                    util_redis.encode_status(status, versions.get(task_id, 0)),
+                    ex=util_redis.STATUS_TTL,
+                )
+                pipe.publish(util_redis.task_status_channel(task_id), notifications[task_id])
+                if owners.get(task_id):
+                    pipe.publish(
+                        util_redis.user_status_channel(owners[task_id]), notifications[task_id]
+                    )
+            await pipe.execute()
+
+        # Now, push the changes to the 'status_updates' topic to let the world know. They
+        # all go to the producer's buffer, which sends them together.
+        log.info(
+            "Pushing task status changes",
+            changes=batch,
+            topic=constants.status_updates_topic,
+        )
+        for task_id, status in batch.items():
+            message = envelope.encode_status_update(
+                task_id, status, versions.get(task_id), owners.get(task_id)
+            )
+            await produce_message(
+                constants.status_updates_topic, message, wait=False, headers=headers.get(task_id)
+            )
+
+
+_status_writer: StatusWriter | None = None
+
+
+def get_status_writer() -> StatusWriter:
+    global _status_writer
+    if _status_writer is None:
+        _status_writer = StatusWriter(
+            max_delay_ms=float(os.getenv("STATUS_FLUSH_MS", default="5")),
+            max_batch=int(os.getenv("STATUS_BATCH_SIZE", default="500")),
+        )
+    return _status_writer
+
+
+async def stop_status_writer():
+    global _status_writer
+    if _status_writer is not None:
+        writer, _status_writer = _status_writer, None
+        await writer.stop()
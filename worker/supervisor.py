@@ -0,0 +1,90 @@
+"""
+Multi-process entry point for the worker. Starts WORKER_PROCESSES copies of job_runner
+(one event loop each). They all join the same consumer group, so Kafka spreads the
+partitions of jobA/jobB/jobC among them (and among the host's cores).
+Children that die are restarted. On SIGTERM/SIGINT, children are asked to stop (they finish
+their in-flight tasks first) and are killed if they don't within WORKER_DRAIN_TIMEOUT seconds.
+"""
+
+import multiprocessing
+import os
+import signal
+import time
+
+import structlog
+
+import job_runner
+
+log = structlog.get_logger()
+
+RESTART_BACKOFF_MAX = 30  # Seconds. Don't spin if a child crashes right after starting
+
+
+def _start_child(ctx, slot: int) -> multiprocessing.Process:
+    process = ctx.Process(target=job_runner.run, args=(slot,), name=f"job_runner-{slot}")
+    process.start()
+    log.info("Started worker process", slot=slot, pid=process.pid)
+    return process
+
+
+def main():
+    num_processes = int(os.getenv("WORKER_PROCESSES", default=str(os.cpu_count() or 1)))
+    drain_timeout = float(os.getenv("WORKER_DRAIN_TIMEOUT", default="30"))
+    ctx = multiprocessing.get_context("spawn")
+
+    stopping = False
+
+    def request_stop(signum, _frame):
+        nonlocal stopping
+        log.info("Supervisor got signal. Stopping workers.", signal=signal.Signals(signum).name)
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    children = {slot: _start_child(ctx, slot) for slot in range(num_processes)}
+    started_at = {slot: time.monotonic() for slot in children}
+    backoff = {slot: 0.0 for slot in children}
+    restart_at: dict[int, float] = {}  # Dead children waiting to be restarted
+
+    while not stopping:
+        now = time.monotonic()
+        for slot, process in children.items():
+            if slot in restart_at:
+                if now >= restart_at[slot]:
+                    del restart_at[slot]
+                    children[slot] = _start_child(ctx, slot)
+                    started_at[slot] = now
+                continue
+            if process.is_alive():
+                continue
+            # Crash-looping children wait longer and longer. One that was up for a while doesn't
+            crashed_quickly = now - started_at[slot] < RESTART_BACKOFF_MAX
+            backoff[slot] = (
+                min(max(backoff[slot] * 2, 1), RESTART_BACKOFF_MAX) if crashed_quickly else 0
+            )
+            restart_at[slot] = now + backoff[slot]
+            log.warning(
+                "Worker process died. Restarting.",
+                slot=slot,
+                pid=process.pid,
+                exitcode=process.exitcode,
+                restart_in=backoff[slot],
+            )
+        time.sleep(0.5)
+
+    for process in children.values():
+        if process.is_alive():
+            process.terminate()  # SIGTERM: job_runner drains and exits
+    deadline = time.monotonic() + drain_timeout
+    for slot, process in children.items():
+        process.join(timeout=max(deadline - time.monotonic(), 0))
+        if process.is_alive():
+            log.warning("Worker process didn't drain in time. Killing it.", slot=slot)
+            process.kill()
+            process.join()
+    log.info("All worker processes stopped")
+
+
+if __name__ == "__main__":
+    main()
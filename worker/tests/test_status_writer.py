@@ -0,0 +1,43 @@
+"""
+Run from the repository root:
+    python -m unittest discover -s worker/tests
+"""
+
+import asyncio
+import os
+import sys
+import unittest
+from pathlib import Path
+
+_root = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(_root / "backend"), str(_root / "worker")]
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from status_writer import StatusWriter  # noqa: E402
+
+
+class StopTest(unittest.IsolatedAsyncioTestCase):
+    async def test_stop_writes_what_is_buffered_and_returns(self):
+        written = []
+
+        async def flush(batch, headers):
+            written.append(dict(batch))
+
+        writer = StatusWriter(max_delay_ms=1000)
+        writer._flush = flush
+        write = asyncio.create_task(writer.write(1, "jobA"))
+        await asyncio.sleep(0)  # Buffered, not flushed yet (max_delay_ms)
+
+        await asyncio.wait_for(writer.stop(), timeout=2)
+        await asyncio.wait_for(write, timeout=2)
+        self.assertEqual(written, [{1: "jobA"}])
+
+    async def test_stop_with_nothing_buffered(self):
+        writer = StatusWriter()
+        writer.start()
+        await asyncio.sleep(0)
+        await asyncio.wait_for(writer.stop(), timeout=2)
+
+
+if __name__ == "__main__":
+    unittest.main()